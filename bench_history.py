@@ -0,0 +1,89 @@
+"""History benchmarks.
+
+- Windowed queries: list scan vs. sorted date index.
+- Memory per loaded post: plain dicts vs. Post records (tracemalloc).
+
+Run with: python bench_history.py
+"""
+
+import gc
+import json
+import os
+import random
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# Same dummy environment as conftest.py so bot.py imports without credentials
+os.environ.setdefault("DISCORD_TOKEN", "bench_token")
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench_key")
+os.environ.setdefault("FACT_CHANNEL_ID", "123456789")
+
+import bot  # noqa: E402
+
+
+def make_history(n_posts: int) -> dict:
+    """Build a history of n_posts spread evenly up to the present, oldest first."""
+    now = datetime.now(timezone.utc)
+    rng = random.Random(n_posts)
+    span_days = max(60, n_posts // 2)
+    posts = [
+        {
+            "date": (now - timedelta(days=span_days * (1 - i / n_posts))).isoformat(),
+            "mode": rng.choice(["fact", "what_if"]),
+            "topic": rng.choice(bot.TOPICS),
+            "wonder_type": rng.choice(bot.WONDER_TYPES),
+            "summary": f"Summary of post {i}. " + "x" * 130,
+            "content": f"Content of post {i}. " + "y" * 600,
+            "had_callback": False,
+        }
+        for i in range(n_posts)
+    ]
+    return {"posts": posts, "used_wonders": [], "used_topics": []}
+
+
+def _queries(history) -> None:
+    bot.get_recent_posts(history, days=14)
+    bot.get_callback_candidate(history)
+
+
+def time_queries(n_posts: int, repeat: int = 20) -> tuple[float, float]:
+    """Seconds per (recent posts + callback candidate) lookup: (scan, indexed)."""
+    history = make_history(n_posts)
+    view = bot._freeze_history(history)
+    scan = timeit.timeit(lambda: _queries(history), number=repeat) / repeat
+    indexed = timeit.timeit(lambda: _queries(view), number=repeat) / repeat
+    return scan, indexed
+
+
+def _traced_bytes(build) -> int:
+    """Bytes still allocated after build() returns, keeping its result alive."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def post_memory(n_posts: int) -> tuple[float, float]:
+    """Bytes per loaded post: (json dicts, Post records)."""
+    text = json.dumps(make_history(n_posts))
+    dicts = _traced_bytes(lambda: json.loads(text)["posts"])
+    posts = _traced_bytes(lambda: [bot.Post.from_dict(p) for p in json.loads(text)["posts"]])
+    return dicts / n_posts, posts / n_posts
+
+
+if __name__ == "__main__":
+    print(f"{'posts':>8}  {'scan':>10}  {'indexed':>10}  {'speedup':>8}")
+    for n in (500, 10_000, 100_000):
+        scan, indexed = time_queries(n, repeat=20 if n <= 10_000 else 3)
+        print(f"{n:>8}  {scan * 1e3:>8.3f}ms  {indexed * 1e3:>8.3f}ms  {scan / indexed:>7.0f}x")
+
+    print()
+    print(f"{'posts':>8}  {'dict/post':>10}  {'Post/post':>10}  {'saved':>6}")
+    for n in (500, 10_000, 100_000):
+        dict_bytes, post_bytes = post_memory(n)
+        print(f"{n:>8}  {dict_bytes:>9.0f}B  {post_bytes:>9.0f}B  {1 - post_bytes / dict_bytes:>6.0%}")
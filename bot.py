@@ -1,14 +1,34 @@
 import asyncio
+import functools
 import discord
 from discord.ext import commands, tasks
 import anthropic
+import httpx
 import os
 import sys
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, time, timezone
 from pathlib import Path
 import random
+from bisect import bisect_right
+from time import monotonic
+
+try:
+    import fcntl
+except ImportError:  # Windows: locking falls back to in-process only
+    fcntl = None
 
 # =============================================================================
 # CONFIGURATION
@@ -31,6 +51,17 @@ ANTHROPIC_API_KEY = get_required_env("ANTHROPIC_API_KEY")
 CHANNEL_ID = int(get_required_env("FACT_CHANNEL_ID"))
 HISTORY_FILE = Path(os.environ.get("HISTORY_FILE", "fact_history.json"))
 
+# History storage backend: "json" rewrites the whole file on every post,
+# "jsonl" appends posts to a write-ahead log next to the snapshot and only
+# rewrites the snapshot when the log is compacted, "sqlite" keeps posts in an
+# indexed database (HISTORY_DB, default: HISTORY_FILE with a .db suffix) and
+# imports an existing HISTORY_FILE on first start.
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "json")
+if HISTORY_BACKEND not in ("json", "jsonl", "sqlite"):
+    print(f"ERROR: Unknown HISTORY_BACKEND: {HISTORY_BACKEND} (expected json, jsonl or sqlite)")
+    sys.exit(1)
+HISTORY_DB = os.environ.get("HISTORY_DB")
+
 # Logging setup
 logging.basicConfig(
     level=logging.INFO,
@@ -44,8 +75,27 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
 
-# Claude client
-claude = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Claude client. Native async, so concurrent generations multiplex on the
+# event loop instead of each holding a worker thread. All calls share one
+# keep-alive connection pool; the limits are sized well above the bot's
+# expected concurrency so the pool is never the bottleneck.
+API_MAX_CONNECTIONS = 20
+API_MAX_KEEPALIVE_CONNECTIONS = 10
+API_KEEPALIVE_EXPIRY = 60  # seconds an idle connection stays open
+
+claude = anthropic.AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    max_retries=0,  # call_claude's retry layer owns retries
+    http_client=anthropic.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=API_MAX_CONNECTIONS,
+            max_keepalive_connections=API_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=API_KEEPALIVE_EXPIRY,
+        ),
+        # Every response (streamed or not) feeds the adaptive concurrency limit
+        event_hooks={"response": [lambda response: _observe_rate_limits(response)]},
+    ),
+)
 
 # =============================================================================
 # CONTENT CONFIGURATION
@@ -77,10 +127,25 @@ TOPICS = [
 
 # Weekly digest posts on Friday (weekday 4)
 POSTING_DAY = 4  # Friday
-
-# Maximum posts to keep in history (prevents unbounded growth)
+POSTING_TIME = time(hour=19, minute=0, tzinfo=timezone.utc)
+
+# The digest is generated ahead of time and staged on disk, so the posting
+# run only has to send it. Pre-generation is attempted at each of these
+# hours (UTC) on posting day until it succeeds. If nothing is staged by
+# POSTING_TIME, the digest is generated live, retried a few times.
+DIGEST_PREGEN_HOURS = range(7, 18)
+DIGEST_LIVE_ATTEMPTS = 3
+DIGEST_LIVE_RETRY_DELAY = 2 * 60  # seconds
+
+# Maximum posts to keep in the live history file. Older posts move to the
+# archive (see ARCHIVE_SEGMENT_POSTS). Not applied to the sqlite backend,
+# whose queries are indexed.
 MAX_HISTORY_POSTS = 500
 
+# Posts pruned from the live history collect in an uncompressed "warm" log
+# and are sealed into a gzip-compressed "cold" segment every this many posts.
+ARCHIVE_SEGMENT_POSTS = 500
+
 # Model configuration: source of truth is models.json (committed to repo).
 # Env vars still win if set, useful for local experimentation without
 # editing the committed file. To upgrade models in prod, edit models.json
@@ -90,34 +155,406 @@ with open(_MODELS_FILE) as _f:
     _models = json.load(_f)
 GENERATION_MODEL = os.environ.get("GENERATION_MODEL", _models["generation_model"])
 SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", _models["summary_model"])
+# Model for hedge requests (see HEDGE_BUDGET); null means the same model as
+# the call being hedged.
+HEDGE_MODEL = os.environ.get("HEDGE_MODEL", _models.get("hedge_model"))
+MODEL_PRICES = {model: price for model, price in _models.get("pricing", {}).items() if not model.startswith("_")}
+
+# Compact the history write-ahead log (jsonl backend) into the snapshot once
+# it grows past this size. ~100 posts' worth; replaying it at startup is cheap.
+HISTORY_LOG_MAX_BYTES = 256 * 1024
 
 # Content variety settings
 RECENT_WONDERS_MEMORY = 5   # Avoid repeating wonder types within ~2 weeks
 RECENT_TOPICS_MEMORY = 8    # Avoid repeating topics within ~4 weeks
 CALLBACK_PROBABILITY = 0.3  # ~30% chance to reference old post
 
+# Model call resilience: transient errors (connection, 429, 5xx/529) are
+# retried with decorrelated jitter (or the server's Retry-After) within an
+# overall per-call deadline. After API_BREAKER_THRESHOLD consecutive
+# failures the circuit opens and calls fail fast for API_BREAKER_COOLDOWN
+# seconds, then a single trial call decides whether to close it again.
+API_MAX_ATTEMPTS = 4
+API_RETRY_BASE_DELAY = 1.0   # seconds
+API_RETRY_MAX_DELAY = 30.0   # seconds
+API_CALL_DEADLINE = 120.0    # seconds, across all attempts
+API_BREAKER_THRESHOLD = 5
+API_BREAKER_COOLDOWN = 60.0  # seconds
+
+# Admission control: every model call waits for model_scheduler, which keeps
+# the bot under the organization's rate limits with a requests/minute and a
+# tokens/minute bucket (tokens estimated as prompt length / 4 + max_tokens).
+# Waiting calls are served by priority, then round-robin across users.
+API_REQUESTS_PER_MINUTE = 50
+API_TOKENS_PER_MINUTE = 40_000
+PRIORITY_DIGEST = 0
+PRIORITY_ON_DEMAND = 1
+PRIORITY_BACKGROUND = 2  # pool refills, summaries, cache refreshes
+
+# Adaptive concurrency (AIMD) on top of the buckets: the number of model
+# calls in flight is capped at a limit that starts at API_CONCURRENCY_MAX.
+# It is halved (at most once per API_CONCURRENCY_DECREASE_INTERVAL) when a
+# response's anthropic-ratelimit-* headers show less than API_HEADROOM_LOW
+# of any limit remaining, or on a 429, and grows by about one per round of
+# calls while more than API_HEADROOM_HIGH remains.
+API_CONCURRENCY_MIN = 1
+API_CONCURRENCY_MAX = 8
+API_HEADROOM_LOW = 0.2
+API_HEADROOM_HIGH = 0.5
+API_CONCURRENCY_DECREASE_INTERVAL = 2.0  # seconds
+
+# Hedged requests: a call still unanswered after the rolling p95 latency of
+# its model (first text for streamed calls) gets a second request, to
+# HEDGE_MODEL if set; the first to answer is used and the other cancelled.
+# Only request kinds listed here are hedged, each at most for the given
+# fraction of its calls. Set to {} to disable hedging.
+HEDGE_BUDGET = {"!fact": 0.1, "!whatif": 0.1, "!puzzle": 0.1}
+HEDGE_WINDOW = 200  # latencies kept per model for the p95
+HEDGE_MIN_SAMPLES = 20  # no hedging until this many have been seen
+
+# Pre-generated content pool for !fact, !whatif and !puzzle. Each mode is
+# refilled up to the high watermark once it drops below the low watermark;
+# entries are discarded when the prompt context they were generated
+# against (build_context_block) changes. Set the high watermark to 0 to
+# disable the pool.
+POOL_LOW_WATERMARK = 1
+POOL_HIGH_WATERMARK = 2
+POOL_IDLE_CHECK = 15 * 60  # seconds between staleness sweeps when idle
+POOL_ERROR_BACKOFF = 5 * 60  # seconds to wait after a failed refill
+
+# On-demand commands that do have to wait for the model send a placeholder
+# embed and edit it as the text streams in. Discord allows roughly 5 edits
+# per 5 seconds per channel, so edits are spaced at least this far apart.
+STREAM_EDIT_INTERVAL = 1.5  # seconds
+STREAM_CURSOR = " ▌"
+
+# Replies to `!fact <topic>` are cached per normalized topic: up to
+# TOPIC_CACHE_VARIANTS different replies each, handed out in turn, for
+# TOPIC_CACHE_TTL seconds. A topic asked for within TOPIC_CACHE_REFRESH_AHEAD
+# seconds of expiry is regenerated in the background.
+TOPIC_CACHE_SIZE = 64  # topics
+TOPIC_CACHE_VARIANTS = 3
+TOPIC_CACHE_TTL = 6 * 60 * 60  # seconds
+TOPIC_CACHE_REFRESH_AHEAD = 30 * 60  # seconds
+
+# Per-request model usage accounting (!usage). Totals per request kind are
+# kept for the whole run; individual requests only for the last this many.
+USAGE_LEDGER_SIZE = 200
+
 # =============================================================================
 # HISTORY MANAGEMENT
 # =============================================================================
 
-# Serializes read-modify-write sequences against the history file.
-# Multiple writers (weekly task, !puzzle's temp_answer) can otherwise clobber
-# each other since each loads, mutates, and saves a separate dict copy.
-HISTORY_LOCK = asyncio.Lock()
+# In-process cache of the parsed history file. Every command used to re-parse
+# the whole JSON document; now one frozen copy is kept and handed out as a
+# read-only view until the file changes on disk (mtime/size) or
+# save_history() bumps the version counter.
+_history_version = 0
+_history_cache = {"key": None, "view": None}
 
 
-def load_history() -> dict:
-    """Load posting history from JSON file."""
+def _history_log_file() -> Path:
+    """Path of the write-ahead log used by the jsonl backend."""
+    return HISTORY_FILE.with_suffix(".log")
+
+
+def _file_stat(path: Path) -> tuple | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _history_stat_key() -> tuple | None:
+    """Identify the on-disk history state; None if the file doesn't exist."""
+    if HISTORY_BACKEND == "sqlite":
+        db = _file_stat(_history_db_file())
+        wal = _file_stat(Path(f"{_history_db_file()}-wal"))
+        return None if db is None else (str(_history_db_file()), db, wal, _history_version)
+    snapshot = _file_stat(HISTORY_FILE)
+    log = _file_stat(_history_log_file()) if HISTORY_BACKEND == "jsonl" else None
+    if snapshot is None and log is None:
+        return None
+    return (str(HISTORY_FILE), snapshot, log, _history_version)
+
+
+def _post_timestamp(post) -> float | None:
+    """Epoch seconds of a post's date (treated as UTC), or None if unusable."""
+    try:
+        return datetime.fromisoformat(post["date"]).replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Field values repeated across many posts. Loaded posts share the string
+# objects in these tables instead of each holding its own copy.
+_INTERNED = {value: value for value in [*TOPICS, *WONDER_TYPES, "fact", "what_if", "puzzle"]}
+_INTERNED_FIELDS = ("mode", "topic", "wonder_type")
+
+# Most posts have one of a handful of key orders; share one tuple per order.
+_POST_KEY_ORDERS = {}
+
+
+def _intern(value):
+    if not isinstance(value, str):
+        return value
+    return _INTERNED.get(value) or sys.intern(value)
+
+
+class Post(Mapping):
+    """A history post loaded from storage.
+
+    Behaves like a read-only dict (so post["topic"], post.get(...) and
+    dict(post) all work) but stores known fields in slots instead of a
+    per-post dict, interns mode/topic/wonder_type, and remembers the
+    original key order so to_dict() round-trips to the same JSON.
+    Unknown keys are kept in a small overflow dict.
+
+    Stored posts keep their body in the blob store and carry only a
+    content_ref hash; post["content"] fetches the body on access, so
+    metadata-only readers never load it.
+    """
+
+    FIELDS = ("date", "mode", "topic", "wonder_type", "summary", "content", "content_ref",
+              "answer", "had_callback")
+    __slots__ = FIELDS + ("_keys", "_extra")
+
+    @classmethod
+    def from_dict(cls, data) -> "Post":
+        if isinstance(data, Post):
+            return data
+        post = cls.__new__(cls)
+        keys = tuple(data)
+        post._keys = _POST_KEY_ORDERS.setdefault(keys, keys)
+        post._extra = None
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                setattr(post, key, _intern(value) if key in _INTERNED_FIELDS else value)
+            else:
+                if post._extra is None:
+                    post._extra = {}
+                post._extra[key] = value
+        return post
+
+    def _raw(self, key):
+        """Stored value of key (content_ref rather than the body)."""
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __getitem__(self, key):
+        if key == "content_ref":
+            raise KeyError(key)
+        if key == "content" and "content_ref" in self._keys:
+            body = get_blob(self.content_ref)
+            if body is None:
+                raise KeyError(key)
+            return body
+        return self._raw(key)
+
+    def __contains__(self, key):
+        if key == "content":
+            return "content" in self._keys or "content_ref" in self._keys
+        return key != "content_ref" and key in self._keys
+
+    def __iter__(self):
+        return ("content" if key == "content_ref" else key for key in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"Post({self.to_dict()!r})"
+
+    def to_dict(self) -> dict:
+        """The stored form, with content_ref in place of an out-of-line body."""
+        return {key: self._raw(key) for key in self._keys}
+
+
+def _json_default(value):
+    """json.dump fallback: Posts serialize as their dict, anything else as str."""
+    if isinstance(value, Post):
+        return value.to_dict()
+    return str(value)
+
+
+class _HistoryView(Mapping):
+    """Read-only snapshot of a history dict with a sorted date index.
+
+    Each post's date is parsed once, here, into an epoch timestamp kept in
+    sorted arrays (overall and per mode), so windowed queries like "last 14
+    days" or "7-21 days ago, facts only" are a bisect plus the matching
+    slice instead of a fromisoformat() call on every post.
+    """
+
+    def __init__(self, history: dict):
+        frozen = {}
+        for key, value in history.items():
+            if key == "posts":
+                frozen[key] = tuple(Post.from_dict(post) for post in value)
+            elif isinstance(value, list):
+                frozen[key] = tuple(value)
+            else:
+                frozen[key] = value
+        self._data = frozen
+
+        # (timestamp, position) pairs; position keeps results in list order
+        dated = sorted(
+            (ts, i) for i, ts in enumerate(map(_post_timestamp, frozen.get("posts", ())))
+            if ts is not None
+        )
+        self._index = {None: _DateIndex(dated)}
+        posts = frozen.get("posts", ())
+        for mode in {post.get("mode") for post in posts}:
+            self._index[mode] = _DateIndex([(ts, i) for ts, i in dated if posts[i].get("mode") == mode])
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def posts_between(self, start: float | None, end: float | None = None,
+                      mode: str | None = None) -> list:
+        """Posts with start < timestamp <= end (either bound optional), in list order."""
+        index = self._index.get(mode)
+        if index is None:
+            return []
+        posts = self._data["posts"]
+        return [posts[i] for i in index.positions(start, end)]
+
+    def last_posts(self, count: int) -> list:
+        return list(self._data.get("posts", ())[-count:])
+
+    def post_count(self) -> int:
+        return len(self._data.get("posts", ()))
+
+
+class _DateIndex:
+    """Sorted timestamps plus the list positions of the posts they belong to."""
+
+    __slots__ = ("timestamps", "order", "chronological")
+
+    def __init__(self, dated: list):
+        self.timestamps = [ts for ts, _ in dated]
+        self.order = [i for _, i in dated]
+        # Posts are normally appended in date order; then positions come out
+        # of a slice already sorted and we can skip the re-sort.
+        self.chronological = all(a < b for a, b in zip(self.order, self.order[1:]))
+
+    def positions(self, start: float | None, end: float | None) -> list:
+        lo = 0 if start is None else bisect_right(self.timestamps, start)
+        hi = len(self.timestamps) if end is None else bisect_right(self.timestamps, end)
+        found = self.order[lo:hi]
+        return found if self.chronological else sorted(found)
+
+
+def _freeze_history(history: dict) -> _HistoryView:
+    """Build a read-only, date-indexed view of a history dict."""
+    return _HistoryView(history)
+
+
+def _thaw_history(view) -> dict:
+    """Return a mutable copy of a history view, safe for the caller to modify.
+
+    The containers are new; the Post objects in them are shared with the
+    view, which is fine since Posts are read-only.
+    """
+    history = {}
+    for key, value in view.items():
+        if key == "posts":
+            history[key] = list(value)
+        elif isinstance(value, tuple):
+            history[key] = list(value)
+        else:
+            history[key] = value
+    return history
+
+
+def _read_history_file() -> dict:
+    """Parse the history file from disk, bypassing the cache."""
+    history = _read_history_snapshot()
+    if HISTORY_BACKEND == "jsonl":
+        _replay_history_log(history)
+    return history
+
+
+def _read_history_snapshot() -> dict:
+    """Parse the JSON snapshot file, or return empty history."""
     if HISTORY_FILE.exists():
         try:
             with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
+                history = json.load(f)
+            history["posts"] = [Post.from_dict(post) for post in history.get("posts", [])]
+            return history
         except json.JSONDecodeError:
             logger.error(f"Corrupted history file, starting fresh")
             return _empty_history()
     return _empty_history()
 
 
+def _replay_history_log(history: dict) -> None:
+    """Apply write-ahead log records newer than the snapshot to history."""
+    log_file = _history_log_file()
+    if not log_file.exists():
+        return
+
+    applied = history.get("wal_seq", 0)
+    with open(log_file, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a crash mid-append; everything
+                # before it is intact.
+                logger.warning(f"Skipping malformed history log line {line_no}")
+                continue
+            if record.get("seq", 0) <= applied:
+                continue  # Already folded into the snapshot
+            if record.get("op") == "post":
+                _apply_post(history, Post.from_dict(record["post"]))
+            elif record.get("op") == "set":
+                history[record["key"]] = record["value"]
+            applied = record["seq"]
+    history["wal_seq"] = applied
+
+
+def history_view() -> Mapping:
+    """Return a read-only view of the history, parsing the file only if it changed.
+
+    Readers (commands, prompt context) should use this instead of
+    load_history(): the view is shared, so it costs nothing to hand out.
+    Coroutines should call it via history_repo.view().
+    """
+    if HISTORY_BACKEND == "sqlite":
+        _history_db()  # Creates (and migrates) the database on first use
+    key = _history_stat_key()
+    if key is None or _history_cache["key"] != key:
+        if HISTORY_BACKEND == "sqlite":
+            view = _SqliteHistoryView(_history_db())
+        else:
+            view = _freeze_history(_read_history_file())
+        _history_cache["key"] = key
+        _history_cache["view"] = view
+    return _history_cache["view"]
+
+
+def load_history() -> dict:
+    """Load posting history as a mutable dict (for read-modify-write paths)."""
+    return _thaw_history(history_view())
+
+
 def _empty_history() -> dict:
     """Return empty history structure."""
     return {
@@ -127,41 +564,890 @@ def _empty_history() -> dict:
     }
 
 
+def _prime_history_cache(history: dict) -> None:
+    """Install an already-parsed history as the cached view after a write."""
+    global _history_version
+    _history_version += 1
+    if HISTORY_BACKEND == "sqlite":
+        # The database view reads lazily; just make the next reader rebuild it.
+        _history_cache["key"] = None
+        return
+    _history_cache["key"] = _history_stat_key()
+    _history_cache["view"] = _freeze_history(history)
+
+
 def save_history(history: dict) -> None:
-    """Save posting history to JSON file atomically."""
+    """Save posting history to JSON file atomically.
+
+    With the jsonl backend this is also the compaction step: the snapshot
+    records the last log sequence number it contains, so the log can be
+    dropped afterwards (and a crash before that just replays nothing new).
+    With the sqlite backend the whole table is replaced in one transaction.
+    """
+    if HISTORY_BACKEND == "sqlite":
+        _replace_history_db(_history_db(), history)
+        _prime_history_cache(history)
+        return
+
+    # Bodies go to the blob store; the snapshot keeps only metadata
+    history["posts"][:] = [_store_post_content(post) for post in history.get("posts", [])]
+
     # Write to temp file first, then rename (atomic on POSIX)
     temp_file = HISTORY_FILE.with_suffix(".tmp")
     with open(temp_file, "w") as f:
-        json.dump(history, f, indent=2, default=str)
+        json.dump(history, f, indent=2, default=_json_default)
     temp_file.rename(HISTORY_FILE)
 
+    if HISTORY_BACKEND == "jsonl":
+        _history_log_file().unlink(missing_ok=True)
 
-def add_to_history(history: dict, post_data: dict) -> None:
-    """Add a new post to history."""
-    history["posts"].append(post_data)
+    # We already have the parsed form, so prime the cache instead of
+    # letting the next reader re-parse what we just wrote.
+    _prime_history_cache(history)
+
+
+def _append_history_log(history: dict, records: list) -> None:
+    """Append records to the write-ahead log in one write, compacting if it got large."""
+    lines = []
+    for record in records:
+        record["seq"] = history.get("wal_seq", 0) + 1
+        history["wal_seq"] = record["seq"]
+        lines.append(json.dumps(record, default=_json_default) + "\n")
+
+    with open(_history_log_file(), "a") as f:
+        f.write("".join(lines))
+        f.flush()
+        log_size = f.tell()
+
+    if log_size > HISTORY_LOG_MAX_BYTES:
+        logger.info("Compacting history log")
+        save_history(history)
+    else:
+        _prime_history_cache(history)
+
+
+# Guards read-modify-write of the history files against other threads in
+# this process (RLock, so nested commit -> compaction is fine) and, via an
+# fcntl advisory lock on <history>.lock, against other processes, e.g. a
+# second replica during a rolling deploy. The sqlite backend gets the same
+# guarantee from BEGIN IMMEDIATE transactions instead.
+_history_thread_lock = threading.RLock()
+_history_lock_depth = 0
+
+
+@contextmanager
+def _history_file_lock():
+    """Hold the cross-process history lock for a read-modify-write."""
+    global _history_lock_depth
+    with _history_thread_lock:
+        if _history_lock_depth or fcntl is None:
+            _history_lock_depth += 1
+            try:
+                yield
+            finally:
+                _history_lock_depth -= 1
+            return
+
+        lock_file = HISTORY_FILE.with_suffix(".lock")
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _history_lock_depth += 1
+            try:
+                yield
+            finally:
+                _history_lock_depth -= 1
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def compact_history() -> None:
+    """Fold the write-ahead log into the snapshot (jsonl backend only)."""
+    if HISTORY_BACKEND == "jsonl":
+        with _history_file_lock():
+            if _history_log_file().exists():
+                save_history(load_history())
+
+
+def _apply_posts(history: dict, posts: list) -> list:
+    """Add posts to an in-memory history, pruning and tracking usage once.
+
+    Returns the posts pruned off the front, for the caller to archive.
+    """
+    history["posts"].extend(posts)
 
     # Prune old posts if over limit
-    if len(history["posts"]) > MAX_HISTORY_POSTS:
+    pruned = []
+    if HISTORY_BACKEND != "sqlite" and len(history["posts"]) > MAX_HISTORY_POSTS:
+        pruned = history["posts"][:-MAX_HISTORY_POSTS]
         history["posts"] = history["posts"][-MAX_HISTORY_POSTS:]
 
     # Track what we've used recently
-    if post_data.get("wonder_type"):
-        history["used_wonders"].append(post_data["wonder_type"])
-        history["used_wonders"] = history["used_wonders"][-RECENT_WONDERS_MEMORY:]
+    wonders = [post["wonder_type"] for post in posts if post.get("wonder_type")]
+    if wonders:
+        history["used_wonders"] = (history["used_wonders"] + wonders)[-RECENT_WONDERS_MEMORY:]
+
+    topics = [post["topic"] for post in posts if post.get("topic")]
+    if topics:
+        history["used_topics"] = (history["used_topics"] + topics)[-RECENT_TOPICS_MEMORY:]
+
+    return pruned
+
+
+def _apply_post(history: dict, post_data: dict) -> None:
+    """Add a single post to an in-memory history."""
+    _apply_posts(history, [post_data])
+
+
+def _commit_history(history: dict | None, posts: list = (), fields: dict | None = None) -> None:
+    """Apply posts and top-level field updates to the stored history, writing once.
+
+    The write is based on the latest stored state, read under the
+    cross-process lock, not on whatever copy the caller holds; afterwards
+    history (if given) is updated in place to match what was stored.
+    """
+    fields = fields or {}
+    history = {} if history is None else history
+
+    if HISTORY_BACKEND == "sqlite":
+        _commit_history_db(history, posts, fields)
+        return
+
+    with _history_file_lock():
+        # Another process (or a stale caller copy) may be behind the file
+        fresh = load_history()
+        history.clear()
+        history.update(fresh)
+
+        posts = [_store_post_content(post) for post in posts]
+        pruned = _apply_posts(history, posts)
+        history.update(fields)
+
+        # Archive before the live file drops them: a crash in between can at
+        # worst archive a post twice, never lose it.
+        if pruned:
+            archive_posts(pruned)
+
+        if HISTORY_BACKEND == "jsonl":
+            records = [{"op": "post", "post": post} for post in posts]
+            records += [{"op": "set", "key": key, "value": value} for key, value in fields.items()]
+            _append_history_log(history, records)
+        else:
+            save_history(history)
+
+        # Only now is nothing live pointing at the archived bodies
+        if pruned:
+            _drop_archived_blobs(pruned, history)
+
+
+def _commit_history_db(history: dict, posts: list, fields: dict) -> None:
+    """sqlite variant of _commit_history(): one BEGIN IMMEDIATE transaction."""
+    conn = _history_db()
+    with _history_thread_lock:
+        if conn.in_transaction:
+            conn.commit()
+        # IMMEDIATE takes the database write lock up front, so usage tracking
+        # read below can't be changed by another process before we write.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            posts = [_store_post_content(post) for post in posts]
+            meta = _read_meta_db(conn)
+            stored = {
+                "posts": [],
+                "used_wonders": meta.get("used_wonders", []),
+                "used_topics": meta.get("used_topics", []),
+            }
+            _apply_posts(stored, posts)
+            _insert_posts_db(conn, posts)
+            if posts:
+                fields = {"used_wonders": stored["used_wonders"], "used_topics": stored["used_topics"], **fields}
+            _write_meta_db(conn, fields)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    history.setdefault("posts", []).extend(posts)
+    history.update(fields)
+    _prime_history_cache(history)
+
+
+def set_history_field(history: dict, key: str, value) -> None:
+    """Set a top-level history field (e.g. temp_answer) and persist it."""
+    _commit_history(history, fields={key: value})
+
+
+def add_to_history(history: dict, post_data: dict) -> None:
+    """Add a new post to history."""
+    _commit_history(history, [post_data])
+
+
+def add_many_to_history(history: dict, posts: list) -> None:
+    """Add several posts to history with a single write.
+
+    Usage tracking is trimmed once and the backend persists once, so a
+    digest of N items costs one file rewrite/log append/transaction.
+    """
+    _commit_history(history, posts)
+
+
+# -----------------------------------------------------------------------------
+# Archive (warm and cold tiers)
+# -----------------------------------------------------------------------------
+#
+# The live history file is the hot tier. Posts pruned from it are appended
+# to warm.jsonl in the archive directory; every ARCHIVE_SEGMENT_POSTS posts
+# that file is gzip-compressed into an immutable cold segment. index.json
+# records each segment's date range and size, so stats never open a segment
+# and date-bounded searches skip segments outside the range. Only explicit
+# archive queries (search_archive, !archive) read segment contents.
+#
+# Archived records carry their body inline rather than a content_ref, so it
+# is compressed along with the segment and the blob can be deleted.
+
+def _archive_dir() -> Path:
+    return HISTORY_FILE.with_name(HISTORY_FILE.stem + "_archive")
+
+
+def _read_archive_index(archive_dir: Path) -> dict:
+    try:
+        with open(archive_dir / "index.json", "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"segments": [], "warm_count": 0}
+
+
+def _write_archive_index(archive_dir: Path, index: dict) -> None:
+    temp_file = archive_dir / "index.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(index, f, indent=2)
+    temp_file.rename(archive_dir / "index.json")
+
+
+def archive_posts(posts: list) -> None:
+    """Move posts pruned from the live history into the warm archive tier."""
+    archive_dir = _archive_dir()
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    index = _read_archive_index(archive_dir)
+
+    warm_file = archive_dir / "warm.jsonl"
+    with open(warm_file, "a+b") as f:
+        # Don't glue the first new post onto a torn line left by a crash
+        torn = f.tell() > 0 and not _ends_with_newline(f)
+    with open(warm_file, "a") as f:
+        f.write("\n" if torn else "")
+        f.write("".join(json.dumps(_archive_record(post), default=str) + "\n" for post in posts))
+    index["warm_count"] += len(posts)
+
+    if index["warm_count"] >= ARCHIVE_SEGMENT_POSTS:
+        _seal_warm_segment(archive_dir, index)
+    _write_archive_index(archive_dir, index)
+
+
+def _archive_record(post) -> dict:
+    """Stored form of an archived post, with its body inline."""
+    data = post.to_dict() if isinstance(post, Post) else dict(post)
+    if "content_ref" not in data:
+        return data
+    body = get_blob(data["content_ref"])
+    if body is None:
+        return data  # Keep the ref; get_blob has already logged the loss
+    return {
+        ("content" if key == "content_ref" else key): (body if key == "content_ref" else value)
+        for key, value in data.items()
+    }
+
+
+def _ends_with_newline(f) -> bool:
+    f.seek(-1, os.SEEK_END)
+    return f.read(1) == b"\n"
+
+
+def _seal_warm_segment(archive_dir: Path, index: dict) -> None:
+    """Compress warm.jsonl into the next cold segment and record it in the index."""
+    warm_file = archive_dir / "warm.jsonl"
+    dates = [post.get("date") for post in _iter_jsonl(warm_file)]
+    dates = sorted(d for d in dates if isinstance(d, str))
+    number = len(index["segments"]) + 1
+    while (archive_dir / f"segment-{number:05d}.jsonl.gz").exists():
+        # Left by a crash before the index recorded it. Its posts are still
+        # in warm.jsonl, so keep it and seal under the next free name.
+        logger.warning(f"Archive segment {number} exists but isn't indexed, skipping its name")
+        number += 1
+    name = f"segment-{number:05d}.jsonl.gz"
+
+    temp_file = archive_dir / (name + ".tmp")
+    with open(warm_file, "rb") as src, gzip.open(temp_file, "wb") as dst:
+        dst.write(src.read())
+    temp_file.rename(archive_dir / name)
+
+    index["segments"].append({
+        "file": name,
+        "first_date": dates[0] if dates else None,
+        "last_date": dates[-1] if dates else None,
+        "count": index["warm_count"],
+    })
+    index["warm_count"] = 0
+    # Record the segment before dropping the warm file: a crash in between
+    # leaves posts archived twice, never in neither.
+    _write_archive_index(archive_dir, index)
+    warm_file.unlink()
+    logger.info(f"Sealed archive segment {name}")
+
+
+def _iter_jsonl(path: Path, opener=open):
+    try:
+        with opener(path, "rt") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn line from a crash mid-append
+                    logger.warning(f"Skipping malformed line {line_no} in {path.name}")
+    except FileNotFoundError:
+        return
+
+
+def archive_stats() -> dict:
+    """Post counts per archive tier, read from the index only."""
+    index = _read_archive_index(_archive_dir())
+    return {
+        "warm": index["warm_count"],
+        "cold": sum(segment["count"] for segment in index["segments"]),
+        "segments": len(index["segments"]),
+    }
+
+
+def search_archive(topic: str | None = None, mode: str | None = None,
+                   since: datetime | None = None, until: datetime | None = None,
+                   limit: int | None = None) -> list:
+    """Search archived posts, newest first.
+
+    topic matches case-insensitively as a substring. since/until bound the
+    post date and let whole cold segments be skipped via the index.
+    """
+    archive_dir = _archive_dir()
+    index = _read_archive_index(archive_dir)
+    since_ts = since.timestamp() if since else None
+    until_ts = until.timestamp() if until else None
+
+    def matches(post) -> bool:
+        if topic and topic.casefold() not in str(post.get("topic", "")).casefold():
+            return False
+        if mode and post.get("mode") != mode:
+            return False
+        if since_ts is not None or until_ts is not None:
+            ts = _post_timestamp(post)
+            if ts is None:
+                return False
+            if since_ts is not None and ts < since_ts:
+                return False
+            if until_ts is not None and ts > until_ts:
+                return False
+        return True
+
+    def overlaps(segment) -> bool:
+        first = _post_timestamp({"date": segment["first_date"]})
+        last = _post_timestamp({"date": segment["last_date"]})
+        if first is None or last is None:
+            return True
+        return not ((since_ts is not None and last < since_ts)
+                    or (until_ts is not None and first > until_ts))
+
+    results = [post for post in _iter_jsonl(archive_dir / "warm.jsonl") if matches(post)][::-1]
+    for segment in reversed(index["segments"]):
+        if limit is not None and len(results) >= limit:
+            break
+        if not overlaps(segment):
+            continue
+        found = [post for post in _iter_jsonl(archive_dir / segment["file"], gzip.open) if matches(post)]
+        results.extend(found[::-1])
+    return results[:limit] if limit is not None else results
+
+
+# -----------------------------------------------------------------------------
+# Blob store (out-of-line post bodies)
+# -----------------------------------------------------------------------------
+#
+# Post bodies are the bulk of the history but nothing on the hot path
+# (context block, !history, !status) reads them. They're stored once per
+# distinct body, keyed by SHA-256, and posts keep only a content_ref. When a
+# post is archived its body moves into the archive record and the blob is
+# deleted, unless a live post still shares it, so the store only grows with
+# the live history.
+
+def _blob_dir() -> Path:
+    return HISTORY_FILE.with_name(HISTORY_FILE.stem + "_blobs")
+
+
+def put_blob(text: str) -> str:
+    """Store text in the blob store (once per distinct text) and return its ref."""
+    ref = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if HISTORY_BACKEND == "sqlite":
+        _history_db().execute("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", (ref, text))
+        return ref
+
+    path = _blob_dir() / ref[:2] / ref
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = path.with_suffix(".tmp")
+        temp_file.write_text(text, encoding="utf-8")
+        temp_file.rename(path)
+    return ref
+
+
+def get_blob(ref: str) -> str | None:
+    """Fetch text from the blob store, or None if it's missing."""
+    if HISTORY_BACKEND == "sqlite":
+        conn = _history_db_reader(_history_db_file())
+        row = conn.execute("SELECT content FROM blobs WHERE hash = ?", (ref,)).fetchone()
+        body = row[0] if row else None
+    else:
+        try:
+            body = (_blob_dir() / ref[:2] / ref).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            body = None
+    if body is None:
+        logger.error(f"Missing post body {ref}")
+    return body
+
+
+def _drop_archived_blobs(archived: list, history: dict) -> None:
+    """Delete the blobs of archived posts that no live post in history uses."""
+    live = {post.content_ref for post in history.get("posts", ())
+            if isinstance(post, Post) and "content_ref" in post._keys}
+    for post in archived:
+        ref = post.content_ref if isinstance(post, Post) and "content_ref" in post._keys else None
+        if ref is not None and ref not in live:
+            (_blob_dir() / ref[:2] / ref).unlink(missing_ok=True)
+
+
+def _store_post_content(post) -> "Post":
+    """Move a post's inline content into the blob store; returns the stored Post."""
+    if isinstance(post, Post) and "content_ref" in post._keys:
+        return post
+    data = post.to_dict() if isinstance(post, Post) else dict(post)
+    if not isinstance(data.get("content"), str):
+        return Post.from_dict(data)
+    ref = put_blob(data["content"])
+    return Post.from_dict({
+        ("content_ref" if key == "content" else key): (ref if key == "content" else value)
+        for key, value in data.items()
+    })
+
+
+# -----------------------------------------------------------------------------
+# SQLite backend
+# -----------------------------------------------------------------------------
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    ts REAL,
+    mode TEXT,
+    topic TEXT,
+    wonder_type TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_posts_date ON posts (ts);
+CREATE INDEX IF NOT EXISTS idx_posts_mode_date ON posts (mode, ts);
+CREATE INDEX IF NOT EXISTS idx_posts_topic ON posts (topic);
+CREATE INDEX IF NOT EXISTS idx_posts_wonder_type ON posts (wonder_type);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+);
+"""
+
+_history_db_conns = {}
+_history_db_readers = threading.local()
+
+
+def _history_db_file() -> Path:
+    """Path of the sqlite history database."""
+    return Path(HISTORY_DB) if HISTORY_DB else HISTORY_FILE.with_suffix(".db")
+
+
+def _history_db() -> sqlite3.Connection:
+    """Open (once per path) the history database, creating and migrating it.
+
+    This is the writer connection, used by the history-io thread. Views
+    read through _history_db_reader() instead.
+    """
+    path = _history_db_file()
+    conn = _history_db_conns.get(str(path))
+    if conn is None:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets readers on other connections run while a write is open
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_HISTORY_SCHEMA)
+        _history_db_conns[str(path)] = conn
+        if _read_meta_db(conn).get("migrated_from") is None:
+            migrate_json_to_sqlite(conn)
+    return conn
+
+
+def _history_db_reader(path: Path) -> sqlite3.Connection:
+    """Read-only connection to the database at path, one per thread.
+
+    Views run their queries on whichever thread holds them (usually the
+    event loop), so they must not share the writer connection with the
+    history-io thread.
+    """
+    conns = _history_db_readers.__dict__.setdefault("conns", {})
+    conn = conns.get(str(path))
+    if conn is None:
+        conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+        conns[str(path)] = conn
+    return conn
+
+
+def _insert_posts_db(conn: sqlite3.Connection, posts) -> None:
+    conn.executemany(
+        "INSERT INTO posts (date, ts, mode, topic, wonder_type, data) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                post.get("date"),
+                _post_timestamp(post),
+                post.get("mode"),
+                post.get("topic"),
+                post.get("wonder_type"),
+                json.dumps(_store_post_content(post).to_dict(), default=str),
+            )
+            for post in posts
+        ],
+    )
+
+
+def _read_meta_db(conn: sqlite3.Connection) -> dict:
+    return {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+
+
+def _write_meta_db(conn: sqlite3.Connection, fields: dict) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+        [(key, json.dumps(value, default=str)) for key, value in fields.items()],
+    )
+
+
+def _replace_history_db(conn: sqlite3.Connection, history) -> None:
+    """Overwrite posts and metadata with the contents of a history dict."""
+    with conn:
+        conn.execute("DELETE FROM posts")
+        conn.execute("DELETE FROM meta WHERE key != 'migrated_from'")
+        _insert_posts_db(conn, history.get("posts", []))
+        _write_meta_db(conn, {k: v for k, v in history.items() if k not in ("posts", "wal_seq")})
+
+
+def migrate_json_to_sqlite(conn: sqlite3.Connection) -> int:
+    """One-shot import of HISTORY_FILE (and any jsonl log) into the database.
+
+    Runs the first time a database is opened; afterwards the JSON file is
+    left alone. Returns the number of imported posts.
+    """
+    history = _read_history_snapshot()
+    _replay_history_log(history)
+    with conn:
+        if conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 0:
+            _insert_posts_db(conn, history.get("posts", []))
+            _write_meta_db(conn, {k: v for k, v in history.items() if k not in ("posts", "wal_seq")})
+        _write_meta_db(conn, {"migrated_from": str(HISTORY_FILE)})
+    if history["posts"]:
+        logger.info(f"Migrated {len(history['posts'])} posts from {HISTORY_FILE} to {_history_db_file()}")
+    return len(history["posts"])
+
+
+class _SqliteHistoryView(Mapping):
+    """Read-only history backed by the sqlite store.
+
+    Built on the history-io thread (via history_repo.view()), which also
+    runs every query the bot's own helpers need: metadata, the post count,
+    posts from the last WINDOW_DAYS (bodies included) and the last
+    LAST_POSTS posts. posts_between()/last_posts()/post_count() answer
+    from those in memory, so commands never touch sqlite on the event
+    loop. Anything outside them, and indexing "posts" directly, falls
+    back to a query on a per-thread read-only connection.
+    """
+
+    # get_callback_candidate looks back 22 days; !history shows up to 20
+    WINDOW_DAYS = 23
+    LAST_POSTS = 20
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._path = _history_db_file()
+        self._meta = {k: v for k, v in _read_meta_db(conn).items() if k != "migrated_from"}
+        self._meta.setdefault("used_wonders", [])
+        self._meta.setdefault("used_topics", [])
+        self._posts = None
+
+        self._count = conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        self._window_start = datetime.now(timezone.utc).timestamp() - self.WINDOW_DAYS * 86400
+        self._window = _query_posts_db(
+            conn, "SELECT data, ts FROM posts WHERE ts > ? ORDER BY id", (self._window_start,)
+        )
+        self._last = _query_posts_db(
+            conn, "SELECT data, ts FROM posts ORDER BY id DESC LIMIT ?", (self.LAST_POSTS,)
+        )[::-1]
+
+    def _query(self, sql: str, params=()) -> list:
+        return [post for post, _ in _query_posts_db(_history_db_reader(self._path), sql, params)]
+
+    def __getitem__(self, key):
+        if key == "posts":
+            if self._posts is None:
+                self._posts = tuple(self._query("SELECT data, ts FROM posts ORDER BY id"))
+            return self._posts
+        value = self._meta[key]
+        return tuple(value) if isinstance(value, list) else value
+
+    def __iter__(self):
+        yield "posts"
+        yield from self._meta
+
+    def __len__(self):
+        return len(self._meta) + 1
+
+    def posts_between(self, start: float | None, end: float | None = None,
+                      mode: str | None = None) -> list:
+        """Posts with start < timestamp <= end (either bound optional), oldest first."""
+        if start is not None and start >= self._window_start:
+            return [
+                post for post, ts in self._window
+                if ts > start and (end is None or ts <= end) and (mode is None or post.get("mode") == mode)
+            ]
+        clauses, params = ["ts IS NOT NULL"], []
+        if start is not None:
+            clauses.append("ts > ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("ts <= ?")
+            params.append(end)
+        if mode is not None:
+            clauses.append("mode = ?")
+            params.append(mode)
+        return self._query(f"SELECT data, ts FROM posts WHERE {' AND '.join(clauses)} ORDER BY id", params)
+
+    def last_posts(self, count: int) -> list:
+        """The most recently added posts, oldest first."""
+        if count <= len(self._last) or len(self._last) == self._count:
+            return [post for post, _ in self._last[-count:]]
+        rows = self._query("SELECT data, ts FROM posts ORDER BY id DESC LIMIT ?", (count,))
+        return rows[::-1]
+
+    def post_count(self) -> int:
+        return self._count
+
+
+def _query_posts_db(conn: sqlite3.Connection, sql: str, params=()) -> list:
+    """Run a (data, ts) query and return (Post, ts) pairs with bodies inlined.
+
+    Inlining means reading a post's content later doesn't go back to the
+    blob table from whatever thread holds the post.
+    """
+    rows = [(json.loads(data), ts) for data, ts in conn.execute(sql, params)]
+    refs = list({data["content_ref"] for data, _ in rows if "content_ref" in data})
+    bodies = {}
+    for i in range(0, len(refs), 500):  # Stay under sqlite's host parameter limit
+        chunk = refs[i:i + 500]
+        bodies.update(conn.execute(
+            f"SELECT hash, content FROM blobs WHERE hash IN ({', '.join('?' * len(chunk))})", chunk
+        ))
+    posts = []
+    for data, ts in rows:
+        if data.get("content_ref") in bodies:
+            data = {
+                ("content" if key == "content_ref" else key): (bodies[value] if key == "content_ref" else value)
+                for key, value in data.items()
+            }
+        posts.append((Post.from_dict(data), ts))
+    return posts
+
+
+def _post_count(history) -> int:
+    count = getattr(history, "post_count", None)
+    return count() if count is not None else len(history.get("posts", []))
+
+
+def _last_posts(history, count: int) -> list:
+    last = getattr(history, "last_posts", None)
+    return last(count) if last is not None else list(history.get("posts", []))[-count:]
+
+
+# -----------------------------------------------------------------------------
+# Staged weekly digest
+# -----------------------------------------------------------------------------
+#
+# The weekly digest is generated hours before it is posted and kept in
+# <stem>_staged_digest.json, keyed by the date it is meant for, so a slow or
+# unavailable API at posting time doesn't delay or drop the post. It isn't
+# part of the history until it has actually been sent.
+
+def _staged_digest_file() -> Path:
+    return HISTORY_FILE.with_name(HISTORY_FILE.stem + "_staged_digest.json")
+
+
+def load_staged_digest(for_date: str) -> dict | None:
+    """Return the digest staged for for_date (YYYY-MM-DD), or None."""
+    try:
+        with open(_staged_digest_file(), "r") as f:
+            staged = json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        logger.warning("Staged digest is corrupt, ignoring it")
+        return None
+    if staged.get("for_date") != for_date:
+        return None
+    return staged
+
+
+def save_staged_digest(for_date: str, fact: dict, whatif: dict) -> None:
+    """Persist a pre-generated digest atomically, replacing any older one."""
+    staged = {
+        "for_date": for_date,
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "fact": fact,
+        "whatif": whatif,
+    }
+    path = _staged_digest_file()
+    temp_file = path.with_suffix(".tmp")
+    with open(temp_file, "w") as f:
+        json.dump(staged, f, indent=2, default=_json_default)
+    temp_file.rename(path)
+
+
+def clear_staged_digest() -> None:
+    _staged_digest_file().unlink(missing_ok=True)
+
+
+# -----------------------------------------------------------------------------
+# Async repository
+# -----------------------------------------------------------------------------
+
+class HistoryRepository:
+    """Async front end to history storage for code running on the event loop.
+
+    The functions above do blocking file/database I/O, so coroutines go
+    through this instead: every operation runs on a dedicated single-thread
+    executor, which keeps disk hiccups away from the Discord heartbeat and
+    also serializes writers. Each write is a complete read-modify-write on
+    that thread, so concurrent callers (weekly task, !puzzle) can't clobber
+    each other's changes.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-io")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def view(self):
+        """Read-only view of the history (see history_view())."""
+        return await self._run(history_view)
+
+    async def load(self) -> dict:
+        """Mutable copy of the history (see load_history())."""
+        return await self._run(load_history)
+
+    async def append(self, post_data: dict) -> None:
+        """Add a post to the stored history."""
+        await self.commit([post_data])
+
+    async def append_many(self, posts: list) -> None:
+        """Add several posts to the stored history with a single write."""
+        await self.commit(posts)
 
-    if post_data.get("topic"):
-        history["used_topics"].append(post_data["topic"])
-        history["used_topics"] = history["used_topics"][-RECENT_TOPICS_MEMORY:]
+    async def set_field(self, key: str, value) -> None:
+        """Set a top-level history field such as temp_answer."""
+        await self.commit(fields={key: value})
 
-    save_history(history)
+    async def commit(self, posts: list = (), fields: dict | None = None) -> None:
+        """Apply posts and field updates in one read-modify-write."""
+        await self._run(lambda: _commit_history(None, posts, fields))
+
+    def transaction(self) -> "HistoryTransaction":
+        """Collect several changes and persist them together on exit.
+
+            async with history_repo.transaction() as txn:
+                txn.add(fact)
+                txn.add(whatif)
+        """
+        return HistoryTransaction(self)
+
+    async def compact(self) -> None:
+        """Fold the jsonl write-ahead log into the snapshot."""
+        await self._run(compact_history)
+
+    async def search_archive(self, **filters) -> list:
+        """Search archived posts (see search_archive())."""
+        return await self._run(lambda: search_archive(**filters))
+
+    async def archive_stats(self) -> dict:
+        """Post counts per archive tier (see archive_stats())."""
+        return await self._run(archive_stats)
+
+    async def staged_digest(self, for_date: str) -> dict | None:
+        """The pre-generated digest for for_date, if any (see load_staged_digest())."""
+        return await self._run(load_staged_digest, for_date)
+
+    async def stage_digest(self, for_date: str, fact: dict, whatif: dict) -> None:
+        """Persist a pre-generated digest (see save_staged_digest())."""
+        await self._run(save_staged_digest, for_date, fact, whatif)
+
+    async def clear_staged_digest(self) -> None:
+        """Remove the staged digest once it has been posted."""
+        await self._run(clear_staged_digest)
+
+
+class HistoryTransaction:
+    """Batch of history changes committed as one write when the block exits.
+
+    Nothing is written if the block raises.
+    """
+
+    def __init__(self, repo: HistoryRepository):
+        self._repo = repo
+        self.posts = []
+        self.fields = {}
+
+    def add(self, post_data: dict) -> None:
+        self.posts.append(post_data)
+
+    def set(self, key: str, value) -> None:
+        self.fields[key] = value
+
+    async def __aenter__(self) -> "HistoryTransaction":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None and (self.posts or self.fields):
+            await self._repo.commit(self.posts, self.fields)
+
+
+history_repo = HistoryRepository()
 
 
 def get_callback_candidate(history: dict) -> dict | None:
     """Find a good post from 1-2 weeks ago to callback to."""
-    if len(history["posts"]) < 7:
+    if _post_count(history) < 7:
         return None
 
     now = datetime.now(timezone.utc)
+
+    posts_between = getattr(history, "posts_between", None)
+    if posts_between is not None:
+        # 7 <= days_ago <= 21, in whole days as below
+        now_ts = now.timestamp()
+        candidates = posts_between(now_ts - 22 * 86400, now_ts - 7 * 86400, mode="fact")
+        return random.choice(candidates) if candidates else None
+
     candidates = []
 
     for post in history["posts"]:
@@ -179,10 +1465,16 @@ def get_callback_candidate(history: dict) -> dict | None:
 
 def get_recent_posts(history: dict, days: int = 7) -> list:
     """Get posts from the last N days."""
+    now = datetime.now(timezone.utc)
+
+    posts_between = getattr(history, "posts_between", None)
+    if posts_between is not None:
+        # days_ago <= days, in whole days as below
+        return posts_between(now.timestamp() - (days + 1) * 86400)
+
     if not history["posts"]:
         return []
 
-    now = datetime.now(timezone.utc)
     recent = []
 
     for post in history["posts"]:
@@ -206,23 +1498,629 @@ def pick_fresh(options: list, recently_used: list) -> str:
 # CONTENT GENERATION
 # =============================================================================
 
-async def call_claude(model: str, max_tokens: int, prompt: str) -> str:
-    """Call Claude API with error handling.
+class ModelCallError(anthropic.APIError):
+    """A model call given up on by the retry layer rather than by the API."""
+
+    def __init__(self, message: str):
+        super().__init__(message, None, body=None)
+
+
+class CircuitOpenError(ModelCallError):
+    """Raised without calling the API while the circuit breaker is open."""
+
 
-    Uses asyncio.to_thread() because the Anthropic SDK is synchronous.
-    Without this, API calls would block the Discord event loop, freezing
-    the bot during content generation (can't respond to commands, etc.).
+class DeadlineExceededError(ModelCallError):
+    """Raised when retries can't finish within API_CALL_DEADLINE."""
+
+
+class CircuitBreaker:
+    """Fails model calls fast while the API is down.
+
+    closed: calls go through; consecutive transient failures are counted.
+    open: calls raise CircuitOpenError until the cooldown has passed.
+    half_open: one trial call is let through; success closes the circuit,
+    failure re-opens it for another cooldown.
     """
-    try:
-        def _call():
-            return claude.messages.create(
-                model=model,
-                max_tokens=max_tokens,
-                messages=[{"role": "user", "content": prompt}]
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def retry_in(self) -> float:
+        """Seconds until an open circuit lets a trial call through."""
+        return max(0.0, self.opened_at + self.cooldown - monotonic())
+
+    def before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError; True if it is the half-open trial."""
+        if self.state == "open":
+            if self.retry_in() > 0:
+                raise CircuitOpenError(f"Anthropic API unavailable, retrying in {self.retry_in():.0f}s")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial_in_flight:
+                raise CircuitOpenError("Anthropic API unavailable, trial call in progress")
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def abandon_trial(self) -> None:
+        """Free the trial slot of a call that was cancelled before it finished.
+
+        Says nothing about the API either way, so the circuit stays half-open
+        and the next call becomes the trial.
+        """
+        self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning(f"Opening API circuit after {self.failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = monotonic()
+
+    def describe(self) -> str:
+        """Short human-readable state, for !status."""
+        if self.state == "open":
+            return f"Unavailable (retry in {self.retry_in():.0f}s)"
+        if self.state == "half_open":
+            return "Recovering"
+        if self.failures:
+            return f"OK ({self.failures} recent failures)"
+        return "OK"
+
+
+api_breaker = CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_COOLDOWN)
+
+
+class RequestUsage:
+    """Model calls made on behalf of one request (a command, a refill, ...)."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started = monotonic()
+        self.latency = None
+        self.calls = []
+        self.coalesced = False  # Served by another request's generation
+
+    @property
+    def cost(self) -> float:
+        return sum(call["cost"] for call in self.calls)
+
+
+class UsageLedger:
+    """Tokens, estimated cost and latency of model calls, per request.
+
+    Code that serves a request wraps it in `with usage_ledger.request(kind):`
+    (commands use @on_demand). Every call_claude() inside it, including
+    calls from tasks it spawns, is charged to that request; calls made
+    outside any request are charged to "other".
+    """
+
+    def __init__(self, size: int):
+        self.recent = deque(maxlen=size)
+        self.totals = {}
+        self._current = ContextVar("usage_request", default=None)
+
+    def _totals_for(self, kind: str) -> dict:
+        return self.totals.setdefault(kind, {
+            "requests": 0, "calls": 0, "coalesced": 0, "input_tokens": 0, "output_tokens": 0,
+            "cost": 0.0, "latency": 0.0,
+        })
+
+    @contextmanager
+    def request(self, kind: str):
+        usage = RequestUsage(kind)
+        token = self._current.set(usage)
+        try:
+            yield usage
+        finally:
+            self._current.reset(token)
+            usage.latency = monotonic() - usage.started
+            totals = self._totals_for(kind)
+            totals["requests"] += 1
+            totals["coalesced"] += usage.coalesced
+            totals["latency"] += usage.latency
+            self.recent.append(usage)
+            logger.info(
+                f"Request {kind}: {len(usage.calls)} model call(s), "
+                f"${usage.cost:.4f}, {usage.latency:.1f}s" + (" (coalesced)" if usage.coalesced else "")
             )
 
-        message = await asyncio.to_thread(_call)
-        return message.content[0].text
+    def mark_coalesced(self) -> None:
+        """Note that the current request shares another's generation (and its cost)."""
+        request = self._current.get()
+        if request is not None:
+            request.coalesced = True
+
+    def current_kind(self) -> str:
+        request = self._current.get()
+        return request.kind if request is not None else "other"
+
+    def record_call(self, model: str, usage, latency: float) -> None:
+        """Charge one completed model call to the current request."""
+        request = self._current.get()
+        kind = request.kind if request is not None else "other"
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        call = {
+            "model": model,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cost": (usage.input_tokens * input_price + usage.output_tokens * output_price) / 1_000_000,
+            "latency": latency,
+        }
+        if request is not None:
+            request.calls.append(call)
+        totals = self._totals_for(kind)
+        totals["calls"] += 1
+        totals["input_tokens"] += call["input_tokens"]
+        totals["output_tokens"] += call["output_tokens"]
+        totals["cost"] += call["cost"]
+
+    def describe(self) -> list:
+        """One line per request kind, for !usage."""
+        lines = []
+        for kind, t in sorted(self.totals.items()):
+            requests = t["requests"] or 1
+            lines.append(
+                f"**{kind}**: {t['requests']} req · {t['calls'] / requests:.1f} calls/req · "
+                f"{t['input_tokens'] + t['output_tokens']:,} tok · ${t['cost']:.4f} · "
+                f"{t['latency'] / requests:.1f}s avg"
+                + (f" · {t['coalesced']} coalesced" if t["coalesced"] else "")
+            )
+        return lines
+
+
+usage_ledger = UsageLedger(USAGE_LEDGER_SIZE)
+
+
+class TokenBucket:
+    """Allows `rate` units per minute, with bursts up to one minute's worth."""
+
+    def __init__(self, rate: float):
+        self.capacity = rate
+        self.available = rate
+        self.per_second = rate / 60
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (oversized amounts wait for a full bucket)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) / self.per_second)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on concurrent model calls, steered by rate-limit headers.
+
+    observe() is called with every API response. The remaining/limit
+    fractions in the anthropic-ratelimit-* headers show how close the
+    organization is to its limits before a 429 ever happens.
+    """
+
+    HEADER_KINDS = ("requests", "tokens", "input-tokens", "output-tokens")
+
+    def __init__(self, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.headroom = None
+        self._last_decrease = 0.0
+
+    def has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def observe(self, status: int, headers) -> None:
+        fractions = []
+        for kind in self.HEADER_KINDS:
+            try:
+                limit = float(headers[f"anthropic-ratelimit-{kind}-limit"])
+                remaining = float(headers[f"anthropic-ratelimit-{kind}-remaining"])
+            except (KeyError, ValueError):
+                continue
+            if limit > 0:
+                fractions.append(remaining / limit)
+        if fractions:
+            self.headroom = min(fractions)
+
+        if status == 429 or (self.headroom is not None and self.headroom < API_HEADROOM_LOW):
+            self._decrease()
+        elif self.headroom is not None and self.headroom > API_HEADROOM_HIGH:
+            # +1 per `limit` responses, i.e. about one per round of calls
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _decrease(self) -> None:
+        now = monotonic()
+        if now - self._last_decrease < API_CONCURRENCY_DECREASE_INTERVAL:
+            return  # Responses already in flight reflect the same pressure
+        self._last_decrease = now
+        previous = int(self.limit)
+        self.limit = max(float(self.minimum), self.limit / 2)
+        if int(self.limit) != previous:
+            logger.warning(f"Rate limit headroom low, model concurrency {previous} -> {int(self.limit)}")
+
+
+class ModelScheduler:
+    """Admission control for model calls: rate limits, priorities, fairness.
+
+    acquire(cost) returns once one request and cost tokens are available.
+    Calls that have to wait are queued by (priority, round, arrival): a
+    user's first waiting call is in round 0, their second in round 1 and so
+    on, so within a priority one busy user can't starve the others. The
+    priority, user and an optional notify(position) callback for queue
+    feedback come from the caller's context (request(), notifying()).
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 max_concurrency: int = API_CONCURRENCY_MAX):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(API_CONCURRENCY_MIN, max_concurrency)
+        self.caller = ContextVar("model_caller", default=(PRIORITY_BACKGROUND, None))
+        self.notify = ContextVar("model_queue_notify", default=None)
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._dispatcher = None
+        self._released = asyncio.Event()
+
+    @contextmanager
+    def request(self, priority: int, user=None):
+        token = self.caller.set((priority, user))
+        try:
+            yield
+        finally:
+            self.caller.reset(token)
+
+    @contextmanager
+    def notifying(self, callback):
+        token = self.notify.set(callback)
+        try:
+            yield
+        finally:
+            self.notify.reset(token)
+
+    def _admit(self, cost: float) -> bool:
+        if not self.concurrency.has_room():
+            return False
+        if self.requests.wait_time(1) > 0 or self.tokens.wait_time(cost) > 0:
+            return False
+        self.requests.take(1)
+        self.tokens.take(cost)
+        self.concurrency.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        """Mark an admitted call as finished, freeing its concurrency slot."""
+        self.concurrency.in_flight -= 1
+        self._released.set()
+
+    def observe_response(self, status: int, headers) -> None:
+        """Feed an API response's rate-limit headers to the concurrency limit."""
+        self.concurrency.observe(status, headers)
+        if self.concurrency.has_room():
+            self._released.set()  # The limit may have grown
+
+    def _waiting(self) -> list:
+        return sorted(entry for entry in self._queue if not entry[3].done())
+
+    async def acquire(self, cost: float) -> None:
+        if not self._waiting() and self._admit(cost):
+            return
+
+        priority, user = self.caller.get()
+        round_no = 0
+        if user is not None:
+            round_no = sum(1 for entry in self._waiting() if entry[0] == priority and entry[4] == user)
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, round_no, next(self._arrivals), future, user, cost]
+        heapq.heappush(self._queue, entry)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        notify = self.notify.get()
+        if notify is not None:
+            notify(self._waiting().index(entry) + 1)
+        try:
+            await future  # Cancelling the caller cancels the future; _dispatch skips it
+        except asyncio.CancelledError:
+            # Cancelled after _dispatch admitted us but before we resumed:
+            # the slot is ours, so hand it back.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    async def _dispatch(self) -> None:
+        while self._queue:
+            entry = self._queue[0]
+            if entry[3].done():
+                heapq.heappop(self._queue)
+                continue
+            if not self.concurrency.has_room():
+                self._released.clear()
+                await self._released.wait()
+                continue
+            if not self._admit(entry[5]):
+                await asyncio.sleep(max(self.requests.wait_time(1), self.tokens.wait_time(entry[5])))
+                continue
+            heapq.heappop(self._queue)
+            entry[3].set_result(None)
+
+    def describe(self) -> str:
+        """Short summary of the queue and current limits, for !status."""
+        concurrency = self.concurrency
+        headroom = "n/a" if concurrency.headroom is None else f"{concurrency.headroom:.0%}"
+        return (
+            f"{concurrency.in_flight}/{int(concurrency.limit)} in flight · "
+            f"{len(self._waiting())} waiting · headroom {headroom}"
+        )
+
+
+model_scheduler = ModelScheduler(API_REQUESTS_PER_MINUTE, API_TOKENS_PER_MINUTE)
+
+
+async def _observe_rate_limits(response: httpx.Response) -> None:
+    """httpx response hook on the Anthropic client (see `claude`)."""
+    model_scheduler.observe_response(response.status_code, response.headers)
+
+
+class Hedger:
+    """Races a second request against calls that run past their model's p95.
+
+    run() starts the call, and if it hasn't answered by the rolling p95 of
+    earlier calls (same model, same streaming mode) and the request kind
+    has hedge budget left, starts a second one. The first to answer wins:
+    for streamed calls that's the first to produce text, so users never see
+    two streams mixed. The other request is cancelled.
+
+    Latency is timed from when model_scheduler admits a call, so time spent
+    queueing neither triggers a hedge nor skews the p95.
+    """
+
+    def __init__(self, budget: dict, window: int, min_samples: int):
+        self.budget = budget
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies = {}
+        self.calls = {}
+        self.hedges = {}
+        self.wins = {}
+
+    def record(self, key: tuple, seconds: float) -> None:
+        self._latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, key: tuple) -> float | None:
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _within_budget(self, kind: str) -> bool:
+        return self.hedges.get(kind, 0) + 1 <= self.budget.get(kind, 0) * self.calls[kind]
+
+    async def run(self, model: str, start, streaming: bool):
+        """Return (result, model used) from start(model, on_response, on_admit).
+
+        start calls on_admit() once model_scheduler has admitted the call. A
+        streamed call calls on_response() when text arrives and only
+        forwards the text while it returns True.
+        """
+        kind = usage_ledger.current_kind()
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        contenders = []
+        winner = {}
+
+        def claim(contender: dict) -> bool:
+            if not winner:
+                winner["contender"] = contender
+                now = monotonic()
+                for other in contenders:
+                    # A cancelled loser's time so far is a lower bound on its
+                    # latency; leaving it out would bias the p95 low.
+                    if other["sent"] is not None:
+                        self.record((other["model"], streaming), now - other["sent"])
+                    if other is not contender:
+                        other["task"].cancel()
+            return winner["contender"] is contender
+
+        def launch(model_name: str) -> None:
+            contender = {"model": model_name, "sent": None}
+            admitted = asyncio.get_running_loop().create_future()
+
+            def on_admit() -> None:
+                if not admitted.done():
+                    contender["sent"] = monotonic()
+                    admitted.set_result(None)
+            contender["admitted"] = admitted
+            contender["task"] = asyncio.create_task(start(model_name, lambda: claim(contender), on_admit))
+            contenders.append(contender)
+
+        try:
+            launch(model)
+            primary = contenders[0]
+            threshold = self.p95((model, streaming))
+            if threshold is not None and self._within_budget(kind):
+                await asyncio.wait({primary["task"], primary["admitted"]}, return_when=asyncio.FIRST_COMPLETED)
+                if not primary["task"].done():
+                    remaining = threshold - (monotonic() - primary["sent"])
+                    await asyncio.wait({primary["task"]}, timeout=max(0.0, remaining))
+                if not winner and not primary["task"].done():
+                    self.hedges[kind] = self.hedges.get(kind, 0) + 1
+                    logger.info(f"Hedging {kind} call to {model} after {threshold:.1f}s")
+                    launch(HEDGE_MODEL or model)
+
+            error = None
+            pending = {contender["task"] for contender in contenders}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for contender in contenders:
+                    task = contender["task"]
+                    if task not in done or task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif claim(contender):
+                        if contender is not contenders[0]:
+                            self.wins[kind] = self.wins.get(kind, 0) + 1
+                        return task.result(), contender["model"]
+            if error is None:  # Every contender was cancelled from outside
+                raise asyncio.CancelledError()
+            raise error
+        finally:
+            for contender in contenders:
+                contender["task"].cancel()
+
+    def describe(self) -> str:
+        """Hedge counts per request kind, for !usage."""
+        if not self.hedges:
+            return "No hedged calls"
+        return " · ".join(
+            f"{kind} {count}/{self.calls.get(kind, 0)} hedged, {self.wins.get(kind, 0)} won"
+            for kind, count in sorted(self.hedges.items())
+        )
+
+
+hedger = Hedger(HEDGE_BUDGET, HEDGE_WINDOW, HEDGE_MIN_SAMPLES)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Transient errors worth retrying: connection problems, 408, 429, 5xx (incl. 529)."""
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 429) or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> float | None:
+    """Server-requested wait in seconds, from retry-after-ms or retry-after."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass  # HTTP-date form; fall back to our own backoff
+    return None
+
+
+def _retry_delay(previous: float, error: Exception) -> float:
+    """Next wait: Retry-After if the server sent one, else decorrelated jitter."""
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return retry_after
+    return min(API_RETRY_MAX_DELAY, random.uniform(API_RETRY_BASE_DELAY, previous * 3))
+
+
+async def _call_with_retries(attempt, cost: float = 0, on_admit=None):
+    """Run attempt() through the circuit breaker, retrying transient failures.
+
+    Every attempt is admitted by model_scheduler (cost is its estimated
+    tokens) first, and on_admit() is called each time it is. Queueing,
+    every attempt and every backoff must fit inside API_CALL_DEADLINE, so
+    a user command never waits longer than that for an answer.
+    """
+    deadline = monotonic() + API_CALL_DEADLINE
+    delay = API_RETRY_BASE_DELAY
+
+    for attempt_no in range(1, API_MAX_ATTEMPTS + 1):
+        try:
+            await asyncio.wait_for(model_scheduler.acquire(cost), timeout=max(0.0, deadline - monotonic()))
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError(f"Still queued after {API_CALL_DEADLINE:.0f}s") from None
+        if on_admit is not None:
+            on_admit()
+        trial = False
+        try:
+            trial = api_breaker.before_call()
+            result = await asyncio.wait_for(attempt(), timeout=max(0.0, deadline - monotonic()))
+        except CircuitOpenError:
+            raise
+        except asyncio.CancelledError:
+            if trial:
+                api_breaker.abandon_trial()
+            raise
+        except asyncio.TimeoutError:
+            api_breaker.record_failure()
+            raise DeadlineExceededError(f"No response within {API_CALL_DEADLINE:.0f}s") from None
+        except Exception as e:
+            if not _is_retryable(e):
+                api_breaker.record_success()  # The API is up; the request was bad
+                raise
+            api_breaker.record_failure()
+            if attempt_no == API_MAX_ATTEMPTS:
+                raise
+            delay = _retry_delay(delay, e)
+            if monotonic() + delay > deadline:
+                raise
+            error_name = e.__class__.__name__
+        else:
+            api_breaker.record_success()
+            return result
+        finally:
+            model_scheduler.release()  # Not held through the backoff
+        logger.warning(f"Transient API error ({error_name}), retry {attempt_no} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+async def _create_message(model: str, max_tokens: int, prompt: str, on_text=None, **options):
+    """Send one prompt with retries, usage accounting and error logging.
+
+    Uses the async client, so awaiting the call yields to the event loop
+    (commands keep working during generation) without tying up a thread.
+    Transient errors are retried by _call_with_retries(), and slow calls
+    may be hedged (see Hedger); what's raised here is final. Extra options
+    (tools, ...) go straight to the API.
+    """
+    request = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": prompt}],
+        **options,
+    }
+    cost = max_tokens + len(prompt) // 4
+
+    async def start(model_name: str, on_response, on_admit):
+        attempt_request = {**request, "model": model_name}
+        if on_text is None:
+            return await _call_with_retries(lambda: claude.messages.create(**attempt_request), cost, on_admit)
+
+        def forward(text: str) -> None:
+            if on_response():
+                on_text(text)
+        return await _call_with_retries(lambda: _stream_message(attempt_request, forward), cost, on_admit)
+
+    started = monotonic()
+    try:
+        message, used_model = await hedger.run(model, start, streaming=on_text is not None)
+        usage_ledger.record_call(used_model, message.usage, monotonic() - started)
+        return message
+    except ModelCallError as e:
+        logger.error(f"Anthropic API call abandoned: {e.message}")
+        raise
     except anthropic.APIConnectionError:
         logger.error("Failed to connect to Anthropic API")
         raise
@@ -234,6 +2132,56 @@ async def call_claude(model: str, max_tokens: int, prompt: str) -> str:
         raise
 
 
+async def call_claude(model: str, max_tokens: int, prompt: str, on_text=None) -> str:
+    """Call Claude API with retries and error handling, returning the text.
+
+    With on_text, the response is streamed and on_text(text) is called with
+    the text generated so far after every chunk. A retried attempt starts
+    over, so on_text may see the text shrink back to the start.
+    """
+    message = await _create_message(model, max_tokens, prompt, on_text)
+    return message.content[0].text
+
+
+async def call_claude_tool(model: str, max_tokens: int, prompt: str, tool: dict) -> dict:
+    """Call Claude API forcing a single call of tool, returning its input.
+
+    Returns {} if the response contains no call of the tool.
+    """
+    message = await _create_message(
+        model, max_tokens, prompt,
+        tools=[tool], tool_choice={"type": "tool", "name": tool["name"]},
+    )
+    for block in message.content:
+        if getattr(block, "type", None) == "tool_use" and block.name == tool["name"]:
+            return block.input if isinstance(block.input, dict) else {}
+    return {}
+
+
+async def _stream_message(request: dict, on_text):
+    """Stream one message, reporting the accumulated text as it arrives.
+
+    A stream cancelled partway (a hedge that lost, say) has still been
+    billed, so the usage reported so far is charged to the current request.
+    """
+    text = ""
+    usage = None
+    started = monotonic()
+    async with claude.messages.stream(**request) as stream:
+        try:
+            async for event in stream:
+                if event.type == "message_start":
+                    usage = event.message.usage
+                elif event.type == "text":
+                    text += event.text
+                    on_text(text)
+        except asyncio.CancelledError:
+            if usage is not None:
+                usage_ledger.record_call(request["model"], usage, monotonic() - started)
+            raise
+        return await stream.get_final_message()
+
+
 async def generate_summary(content: str) -> str:
     """Generate a concise summary of a post using Haiku."""
     prompt = f"Summarize this in 1 sentence (under 100 words), focusing on the core concept or question:\n\n{content}"
@@ -241,6 +2189,71 @@ async def generate_summary(content: str) -> str:
     return response.strip()
 
 
+def _fallback_summary(content: str) -> str:
+    """First sentence of the content, for when the summary call fails."""
+    first = content.strip().split(". ", 1)[0]
+    return first[:200]
+
+
+async def summarize_posts(posts: list) -> None:
+    """Fill in the summary of every post that doesn't have one yet."""
+    missing = [post for post in posts if not post.get("summary")]
+    results = await asyncio.gather(
+        *(generate_summary(post["content"]) for post in missing), return_exceptions=True
+    )
+    for post, result in zip(missing, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Summary failed for {post.get('mode')} post, using its first sentence: {result}")
+            result = _fallback_summary(post["content"])
+        post["summary"] = result
+
+
+# Fields a structured generation call can return, with the instructions the
+# model sees for each (as the submit_post tool's input schema).
+STRUCTURED_FIELDS = {
+    "content": "The post exactly as it should be shown, following every requirement above.",
+    "summary": "One sentence (under 100 words) summarizing the post's core concept or question.",
+    "answer": "The puzzle's answer with a short explanation. Not included in content.",
+}
+
+
+def _post_tool(fields: tuple) -> dict:
+    return {
+        "name": "submit_post",
+        "description": "Submit the finished post.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                name: {"type": "string", "description": STRUCTURED_FIELDS[name]} for name in fields
+            },
+            "required": list(fields),
+        },
+    }
+
+
+async def generate_structured(prompt: str, fields: tuple) -> dict | None:
+    """Generate several fields of a post (see STRUCTURED_FIELDS) in one call.
+
+    Returns the fields that came back as non-empty strings, or None if any
+    field other than the summary is missing so the caller can fall back to
+    plain generation. A missing summary is left out and filled in later by
+    summarize_posts() with the separate summary call.
+    """
+    data = await call_claude_tool(GENERATION_MODEL, 1024, prompt, _post_tool(fields))
+    result = {}
+    for name in fields:
+        value = data.get(name)
+        if isinstance(value, str) and value.strip():
+            result[name] = value.strip()
+    missing = [name for name in fields if name not in result]
+    if [name for name in missing if name != "summary"]:
+        logger.warning(f"Structured output missing {', '.join(missing)}, falling back to plain generation")
+        return None
+    if missing:
+        logger.warning("Structured output missing summary, it will be generated separately")
+    return result
+
+
 def build_context_block(history: dict) -> str:
     """Build context from history to send to Claude."""
     recent = get_recent_posts(history, days=14)
@@ -260,8 +2273,12 @@ def build_context_block(history: dict) -> str:
     return "\n".join(lines)
 
 
-async def generate_fact(history: dict) -> dict:
-    """Generate a surprising fact."""
+async def generate_fact(history: dict, on_text=None, with_summary: bool = False) -> dict:
+    """Generate a surprising fact, streaming the text to on_text if given.
+
+    with_summary asks for the summary in the same (structured) call, for
+    facts that are going to be saved to history.
+    """
     topic = pick_fresh(TOPICS, history.get("used_topics", []))
     wonder = pick_fresh(WONDER_TYPES, history.get("used_wonders", []))
     context = build_context_block(history)
@@ -300,21 +2317,25 @@ Requirements:
 - No preamble—start directly with the surprising content
 - Close with one relevant emoji"""
 
-    content = await call_claude(GENERATION_MODEL, 1024, prompt)
-    summary = await generate_summary(content)
+    post = await generate_structured(prompt, ("content", "summary")) if with_summary else None
+    if post is None:
+        post = {"content": await call_claude(GENERATION_MODEL, 1024, prompt, on_text=on_text)}
 
     return {
-        "content": content,
+        **post,
         "mode": "fact",
         "topic": topic,
         "wonder_type": wonder,
-        "summary": summary,
         "had_callback": callback is not None,
     }
 
 
-async def generate_what_if(history: dict) -> dict:
-    """Generate an absurd hypothetical answered with real physics/math."""
+async def generate_what_if(history: dict, on_text=None, with_summary: bool = False) -> dict:
+    """Generate an absurd hypothetical answered with real physics/math.
+
+    Streams the text to on_text if given (see call_claude()); with_summary
+    works as for generate_fact().
+    """
     topic = pick_fresh(TOPICS, history.get("used_topics", []))
     context = build_context_block(history)
 
@@ -343,19 +2364,68 @@ Requirements:
 - No preamble—start with the hypothetical question directly
 - Close with one relevant emoji"""
 
-    content = await call_claude(GENERATION_MODEL, 1024, prompt)
-    summary = await generate_summary(content)
+    post = await generate_structured(prompt, ("content", "summary")) if with_summary else None
+    if post is None:
+        post = {"content": await call_claude(GENERATION_MODEL, 1024, prompt, on_text=on_text)}
 
     return {
-        "content": content,
+        **post,
         "mode": "what_if",
         "topic": topic,
-        "summary": summary,
     }
 
 
-async def generate_puzzle(history: dict) -> dict:
-    """Generate an intriguing puzzle."""
+async def generate_topic_fact(topic: str, on_text=None) -> str:
+    """Generate a fact about a user-chosen topic (`!fact <topic>`)."""
+    prompt = f"""Share a genuinely surprising fact about {topic}.
+
+Requirements:
+- Lead with the surprise—the thing that breaks intuition
+- Include a vivid analogy
+- Connect to everyday experience if possible
+- End with a question or "notice this next time..."
+- 3-5 sentences
+- No preamble
+- Close with one emoji"""
+
+    return await call_claude(GENERATION_MODEL, 1024, prompt, on_text=on_text)
+
+
+class AnswerSplitter:
+    """Spots the ANSWER: marker in a streamed puzzle as soon as it arrives.
+
+    Fed the accumulated text (call_claude's on_text), it only scans what's
+    new since the last call, and calls on_puzzle(text_before_marker) once.
+    """
+
+    MARKER = "ANSWER:"
+
+    def __init__(self, on_puzzle):
+        self.on_puzzle = on_puzzle
+        self.puzzle = None
+        self._scanned = 0
+
+    def feed(self, text: str) -> None:
+        if self.puzzle is not None:
+            return
+        if len(text) < self._scanned:
+            self._scanned = 0  # A retried attempt started over
+        index = text.find(self.MARKER, max(0, self._scanned - len(self.MARKER) + 1))
+        self._scanned = len(text)
+        if index >= 0:
+            self.puzzle = text[:index].strip()
+            self.on_puzzle(self.puzzle)
+
+
+async def generate_puzzle(history: dict, on_puzzle=None) -> dict:
+    """Generate an intriguing puzzle.
+
+    The puzzle and answer come back as separate fields of one structured
+    call. With on_puzzle, the response is instead streamed as text and
+    on_puzzle({"content", "topic"}) is called as soon as the puzzle part is
+    complete (at the ANSWER: marker), while the answer is still being
+    generated.
+    """
     topic = pick_fresh(TOPICS, history.get("used_topics", []))
     context = build_context_block(history)
 
@@ -372,11 +2442,24 @@ Requirements:
 - 2-4 sentences for the puzzle
 - Do NOT repeat puzzles from <recent_posts>
 - No preamble—start with the puzzle directly
-- Close with 🤔
+- Close with 🤔"""
 
-After the puzzle, provide the answer in a SEPARATE section marked ANSWER: that will be posted tomorrow."""
-
-    full_response = await call_claude(GENERATION_MODEL, 1024, prompt)
+    if on_puzzle is None:
+        post = await generate_structured(
+            prompt + "\n\nGive the answer, which will be posted tomorrow, in the answer field.",
+            ("content", "answer"),
+        )
+        if post is not None:
+            return {**post, "mode": "puzzle", "topic": topic}
+
+    splitter = None
+    if on_puzzle is not None:
+        splitter = AnswerSplitter(lambda puzzle: on_puzzle({"content": puzzle, "topic": topic}))
+    full_response = await call_claude(
+        GENERATION_MODEL, 1024,
+        prompt + "\n\nAfter the puzzle, provide the answer in a SEPARATE section marked ANSWER: that will be posted tomorrow.",
+        on_text=splitter.feed if splitter else None,
+    )
 
     # Parse out puzzle and answer
     if "ANSWER:" in full_response:
@@ -386,27 +2469,398 @@ After the puzzle, provide the answer in a SEPARATE section marked ANSWER: that w
     else:
         puzzle = full_response
         answer = "(Answer not available)"
-
-    summary = await generate_summary(puzzle)
+    if splitter is not None and splitter.puzzle is None:
+        on_puzzle({"content": puzzle, "topic": topic})  # No marker; deliver what we have
 
     return {
         "content": puzzle,
         "mode": "puzzle",
         "topic": topic,
-        "summary": summary,
         "answer": answer,
     }
 
 
 async def generate_weekly_digest(history: dict) -> tuple[dict, dict]:
-    """Generate a fact and what-if for the weekly digest."""
+    """Generate a fact and what-if for the weekly digest, with summaries."""
     fact_result, whatif_result = await asyncio.gather(
-        generate_fact(history),
-        generate_what_if(history)
+        generate_fact(history, with_summary=True),
+        generate_what_if(history, with_summary=True)
     )
     return fact_result, whatif_result
 
 
+# Held while staging, so the on_ready catch-up and a scheduled
+# pregenerate_digest run can't both see nothing staged and generate twice
+_staging_lock = asyncio.Lock()
+_digest_catch_up = {"task": None}
+
+
+async def stage_weekly_digest(for_date: str) -> None:
+    """Generate the digest for for_date ahead of time, unless one is staged."""
+    async with _staging_lock:
+        if await history_repo.staged_digest(for_date) is not None:
+            return
+        history = await history_repo.view()
+        with usage_ledger.request("digest pre-generation"), model_scheduler.request(PRIORITY_DIGEST):
+            fact, whatif = await generate_weekly_digest(history)
+            await summarize_posts([fact, whatif])  # Hours before posting, so no need to defer
+        await history_repo.stage_digest(for_date, fact, whatif)
+    logger.info(f"Staged digest for {for_date}: fact about {fact.get('topic')}, what-if about {whatif.get('topic')}")
+
+
+async def generate_weekly_digest_live() -> tuple[dict, dict]:
+    """Generate the digest at posting time, for when nothing was staged.
+
+    call_claude already retries transient errors; this adds a few spaced-out
+    attempts on top so an outage of a few minutes delays the post instead of
+    dropping it.
+    """
+    for attempt in range(1, DIGEST_LIVE_ATTEMPTS + 1):
+        try:
+            return await generate_weekly_digest(await history_repo.view())
+        except anthropic.APIError as e:
+            if attempt == DIGEST_LIVE_ATTEMPTS:
+                raise
+            logger.warning(f"Live digest attempt {attempt} failed, retrying in {DIGEST_LIVE_RETRY_DELAY}s: {e}")
+            await asyncio.sleep(DIGEST_LIVE_RETRY_DELAY)
+
+
+# Word endings that look plural but usually aren't (physics, chaos, ...)
+_NOT_PLURAL = ("ss", "us", "is", "ics", "os", "as")
+# Words the suffix rules below get wrong: same in both numbers, or -ie
+# nouns whose plural isn't -y + "ies"
+_SINGULAR_EXCEPTIONS = {
+    "series": "series",
+    "species": "species",
+    "means": "means",
+    "calories": "calorie",
+    "movies": "movie",
+    "cookies": "cookie",
+    "pies": "pie",
+    "ties": "tie",
+}
+
+
+def _singular(word: str) -> str:
+    if word in _SINGULAR_EXCEPTIONS:
+        return _SINGULAR_EXCEPTIONS[word]
+    if len(word) <= 3 or not word.endswith("s") or word.endswith(_NOT_PLURAL):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    return word[:-1]
+
+
+def normalize_topic(topic: str | None) -> str | None:
+    """Canonical form of a user-supplied topic, for matching equal requests.
+
+    Casefolds, collapses whitespace and folds simple English plurals, so
+    "Black  Holes" and "black hole" match.
+    """
+    if topic is None:
+        return None
+    return " ".join(_singular(word) for word in topic.casefold().split())
+
+
+def flight_key(topic: str) -> tuple:
+    """SingleFlight key for `!fact <topic>`: requests match if their topics do.
+
+    Only topic requests are coalesced. Random !fact, !whatif and !puzzle
+    requests each get their own generation; sharing one would hand
+    concurrent users the same "random" post (and the same puzzle answer).
+    """
+    return ("fact", normalize_topic(topic))
+
+
+class SingleFlight:
+    """Coalesces concurrent identical generations into one model call.
+
+    run(key, start) starts start(publish) as a shared task unless one with
+    the same key is already in flight, in which case the caller just waits
+    for that one. Anything the generation passes to publish (streamed text,
+    an early puzzle) is fanned out to every waiter's listener, and replayed
+    to waiters that join late. A waiter that goes away doesn't cancel the
+    generation for the others; when the last one goes, it is cancelled.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.coalesced = 0
+
+    async def run(self, key, start, listener=None):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = {"listeners": [], "published": [], "waiters": 0}
+
+            def publish(value):
+                flight["published"] = [value]
+                for callback in list(flight["listeners"]):
+                    callback(value)
+
+            flight["task"] = asyncio.create_task(start(publish))
+            flight["task"].add_done_callback(lambda _: self._forget(key, flight))
+            self._flights[key] = flight
+        else:
+            self.coalesced += 1
+            usage_ledger.mark_coalesced()
+
+        flight["waiters"] += 1
+        if listener is not None:
+            flight["listeners"].append(listener)
+            for value in flight["published"]:
+                listener(value)
+        try:
+            result = await asyncio.shield(flight["task"])
+        finally:
+            flight["waiters"] -= 1
+            if listener is not None:
+                flight["listeners"].remove(listener)
+            if flight["waiters"] == 0 and not flight["task"].done():
+                self._forget(key, flight)  # New requests start afresh
+                flight["task"].cancel()
+        # Each waiter gets its own copy to annotate
+        return dict(result) if isinstance(result, dict) else result
+
+    def _forget(self, key, flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+single_flight = SingleFlight()
+
+
+class ContentPool:
+    """Buffer of ready-made on-demand content, refilled in the background.
+
+    Commands take() an entry in O(1) instead of waiting on the model; a
+    background task tops each mode back up. Every entry remembers the
+    context block it was generated against and is thrown away once the
+    history has moved on, so pooled content never repeats something the
+    live prompt would have told the model to avoid.
+    """
+
+    # Resolved at call time (not bound here) so tests can patch the generators
+    GENERATORS = {
+        "fact": lambda history: generate_fact(history),
+        "what_if": lambda history: generate_what_if(history),
+        "puzzle": lambda history: generate_puzzle(history),
+    }
+
+    def __init__(self, low: int, high: int):
+        self.low = low
+        self.high = high
+        self._ready = {mode: deque() for mode in self.GENERATORS}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, mode: str, history) -> dict | None:
+        """Pop a ready entry that is still current for history, or None."""
+        signature = build_context_block(history)
+        ready = self._ready[mode]
+        result = None
+        while ready:
+            entry_signature, entry = ready.popleft()
+            if entry_signature == signature:
+                result = entry
+                break
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if len(ready) < self.low:
+            self._wakeup.set()
+        return result
+
+    def ready_count(self, mode: str) -> int:
+        return len(self._ready[mode])
+
+    async def refill(self) -> None:
+        """Drop stale entries, then top up every mode below the low watermark."""
+        for mode, generate in self.GENERATORS.items():
+            history = await history_repo.view()
+            signature = build_context_block(history)
+            ready = self._ready[mode]
+            for entry in [e for e in ready if e[0] != signature]:
+                ready.remove(entry)
+            if len(ready) >= self.low:
+                continue
+            while len(ready) < self.high:
+                with usage_ledger.request(f"pool {mode}"):
+                    result = await generate(history)
+                if build_context_block(await history_repo.view()) != signature:
+                    break  # History changed while generating; next pass redoes it
+                ready.append((signature, result))
+            logger.info(f"Content pool: {len(ready)} {mode} ready")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refill()
+                timeout = POOL_IDLE_CHECK
+            except anthropic.APIError as e:
+                logger.warning(f"Content pool refill failed: {e}")
+                timeout = POOL_ERROR_BACKOFF
+            except Exception:
+                # Anything else (a bad parse, a bug) mustn't end the refill loop
+                logger.exception("Content pool refill failed")
+                timeout = POOL_ERROR_BACKOFF
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """Start the background refill task (no-op if disabled or running)."""
+        if self.high > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+
+content_pool = ContentPool(POOL_LOW_WATERMARK, POOL_HIGH_WATERMARK)
+
+
+class TopicCache:
+    """LRU cache of `!fact <topic>` replies, a few variants per topic, with a TTL.
+
+    Until a topic has its full set of variants every request is a miss that
+    generates (and adds) a new one; after that, requests are served from
+    the variants in turn. Entries expire ttl seconds after their first
+    variant, and one that is used close to expiry is regenerated in the
+    background so popular topics don't fall back to the model.
+    """
+
+    def __init__(self, size: int, variants: int, ttl: float, refresh_ahead: float):
+        self.size = size
+        self.variants = variants
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = OrderedDict()
+        self._refreshing = {}  # key -> background refresh task
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def _new_entry(self, topic: str, variants: list) -> dict:
+        return {"topic": topic, "variants": variants, "next": 0, "expires": monotonic() + self.ttl}
+
+    def get(self, topic: str) -> str | None:
+        """Next cached variant for topic, or None if it should be generated."""
+        key = normalize_topic(topic)
+        entry = self._entries.get(key)
+        now = monotonic()
+        if entry is not None and now >= entry["expires"]:
+            del self._entries[key]
+            entry = None
+        if entry is None or len(entry["variants"]) < self.variants:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        content = entry["variants"][entry["next"] % len(entry["variants"])]
+        entry["next"] += 1
+        if now >= entry["expires"] - self.refresh_ahead and key not in self._refreshing:
+            self._refreshing[key] = asyncio.create_task(self._refresh(key, entry["topic"]))
+        return content
+
+    def add(self, topic: str, content: str) -> None:
+        """Add a freshly generated reply as a variant for topic."""
+        key = normalize_topic(topic)
+        entry = self._entries.get(key)
+        if entry is None or monotonic() >= entry["expires"]:
+            entry = self._entries[key] = self._new_entry(topic, [])
+        if len(entry["variants"]) < self.variants and content not in entry["variants"]:
+            entry["variants"].append(content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def _refresh(self, key: str, topic: str) -> None:
+        # Started from a !fact command, whose scheduler priority, user and
+        # queue notice this task would otherwise inherit
+        try:
+            with usage_ledger.request("topic cache refresh"), \
+                    model_scheduler.request(PRIORITY_BACKGROUND), model_scheduler.notifying(None):
+                variants = [await generate_topic_fact(topic) for _ in range(self.variants)]
+            if key in self._entries:  # Not evicted meanwhile
+                self._entries[key] = self._new_entry(topic, variants)
+                self.refreshes += 1
+        except anthropic.APIError as e:
+            logger.warning(f"Topic cache refresh for {topic!r} failed: {e}")
+        except Exception:
+            logger.exception(f"Topic cache refresh for {topic!r} failed")
+        finally:
+            self._refreshing.pop(key, None)
+
+    def describe(self) -> str:
+        """Short summary of the counters, for !status."""
+        return f"{len(self._entries)} topics · {self.hits} hits · {self.misses} misses"
+
+
+topic_cache = TopicCache(TOPIC_CACHE_SIZE, TOPIC_CACHE_VARIANTS, TOPIC_CACHE_TTL, TOPIC_CACHE_REFRESH_AHEAD)
+
+
+class SummaryQueue:
+    """Summarizes delivered posts in the background, then commits them.
+
+    Posts are only summarized for the history (build_context_block reads
+    the summaries), so nothing a user sees waits on the summary model.
+    Callers submit() posts once they have been sent; each batch is
+    summarized and written to history with a single commit.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def submit(self, posts: list, on_commit=None) -> None:
+        """Queue posts to be summarized and then added to history.
+
+        on_commit (a coroutine function) is awaited once they have been
+        written, and not at all if that fails.
+        """
+        self._queue.put_nowait((posts, on_commit))
+        self.start()
+
+    async def process(self, posts: list, on_commit=None) -> None:
+        with usage_ledger.request("summary"):
+            await summarize_posts(posts)
+        await history_repo.append_many(posts)
+        logger.info(f"Committed {len(posts)} post(s) to history")
+        if on_commit is not None:
+            await on_commit()
+
+    async def _run(self) -> None:
+        while True:
+            posts, on_commit = await self._queue.get()
+            try:
+                await self.process(posts, on_commit)
+            except Exception as e:
+                logger.error(f"Failed to commit summarized posts: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def join(self) -> None:
+        """Wait until every submitted batch has been committed."""
+        await self._queue.join()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        """Start the background worker (no-op if running)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+
+summary_queue = SummaryQueue()
+
+
 def truncate_for_embed(text: str, max_length: int = 1024) -> str:
     """Truncate text to fit Discord embed field limits."""
     if len(text) <= max_length:
@@ -414,6 +2868,70 @@ def truncate_for_embed(text: str, max_length: int = 1024) -> str:
     return text[:max_length - 3] + "..."
 
 
+class StreamingEmbed:
+    """Embed sent as a placeholder and edited in place while text streams in.
+
+        async with StreamingEmbed(ctx, embed) as live:
+            result = await generate_fact(history, on_text=live.update)
+            embed.description = result["content"]
+
+    update() only records the latest text; a background flush edits the
+    message at most once per STREAM_EDIT_INTERVAL with whatever is newest.
+    On a clean exit the embed is edited one last time as the caller left
+    it; if the block raises, the placeholder is deleted. While the block
+    runs, a model call queued by model_scheduler shows its queue position.
+    """
+
+    def __init__(self, ctx, embed: discord.Embed):
+        self.ctx = ctx
+        self.embed = embed
+        self.message = None
+        self._text = ""
+        self._last_edit = 0.0
+        self._flush_task = None
+
+    async def __aenter__(self) -> "StreamingEmbed":
+        self.message = await self.ctx.send(embed=self.embed)
+        self._last_edit = monotonic()
+        self._notify_token = model_scheduler.notify.set(self.queued)
+        return self
+
+    def queued(self, position: int) -> None:
+        """Show the call's place in the model queue until text arrives."""
+        self.update(f"Busy right now, you're #{position} in line...")
+
+    def update(self, text: str) -> None:
+        self._text = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        shown = None
+        while self._text != shown:
+            await asyncio.sleep(max(0.0, self._last_edit + STREAM_EDIT_INTERVAL - monotonic()))
+            shown = self._text
+            self.embed.description = truncate_for_embed(shown + STREAM_CURSOR)
+            try:
+                await self.message.edit(embed=self.embed)
+            except discord.HTTPException as e:
+                logger.debug(f"Streaming edit failed: {e}")
+            self._last_edit = monotonic()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        model_scheduler.notify.reset(self._notify_token)
+        if self._flush_task is not None:
+            # Let an in-flight edit finish cancelling so it can't land after the final one
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if exc_type is None:
+            await self.message.edit(embed=self.embed)
+        else:
+            try:
+                await self.message.delete()
+            except discord.HTTPException:
+                pass
+
+
 # =============================================================================
 # DISCORD BOT
 # =============================================================================
@@ -432,6 +2950,18 @@ async def on_ready():
         )
     )
 
+    await history_repo.compact()
+    content_pool.start()
+    summary_queue.start()
+
+    if not pregenerate_digest.is_running():
+        pregenerate_digest.start()
+        logger.info("Digest pre-generation task started")
+    if _digest_catch_up["task"] is None:
+        # The loop only fires at its scheduled hours; catch up once per
+        # process if we started on posting day after the first of them.
+        _digest_catch_up["task"] = asyncio.create_task(pregenerate_digest())
+
     if not weekly_post.is_running():
         weekly_post.start()
         logger.info("Weekly post task started")
@@ -451,7 +2981,28 @@ async def on_command_error(ctx, error):
         await ctx.send("Something went wrong. Please try again later.")
 
 
-@tasks.loop(time=time(hour=19, minute=0, tzinfo=timezone.utc))
+@tasks.loop(time=[time(hour=hour, tzinfo=timezone.utc) for hour in DIGEST_PREGEN_HOURS])
+async def pregenerate_digest():
+    """Stage the weekly digest ahead of posting time (posting day only)."""
+    now = datetime.now(timezone.utc)
+    if now.weekday() != POSTING_DAY or now.timetz() >= POSTING_TIME:
+        return
+
+    try:
+        await stage_weekly_digest(now.date().isoformat())
+    except anthropic.APIError as e:
+        logger.warning(f"Digest pre-generation failed, will retry next hour: {e}")
+    except Exception as e:
+        logger.error(f"Error pre-generating weekly digest: {e}", exc_info=True)
+
+
+@pregenerate_digest.before_loop
+async def before_pregenerate_digest():
+    """Wait for bot to be ready before starting task."""
+    await bot.wait_until_ready()
+
+
+@tasks.loop(time=POSTING_TIME)
 async def weekly_post():
     """Post weekly digest to the designated channel (Fridays only)."""
     # Only post on Friday
@@ -464,11 +3015,14 @@ async def weekly_post():
         return
 
     try:
-        logger.info("Generating weekly digest...")
-        history = load_history()
-
-        # Generate both items
-        fact, whatif = await generate_weekly_digest(history)
+        today = datetime.now(timezone.utc).date().isoformat()
+        staged = await history_repo.staged_digest(today)
+        if staged is not None:
+            fact, whatif = staged["fact"], staged["whatif"]
+        else:
+            logger.warning("No staged digest for today, generating it live...")
+            with usage_ledger.request("digest live"), model_scheduler.request(PRIORITY_DIGEST):
+                fact, whatif = await generate_weekly_digest_live()
 
         # Build the embed with both items
         embed = discord.Embed(
@@ -491,15 +3045,17 @@ async def weekly_post():
         await channel.send(embed=embed)
         logger.info(f"Posted weekly digest: fact about {fact.get('topic')}, what-if about {whatif.get('topic')}")
 
-        # Save both to history (re-load under lock to avoid clobbering
-        # concurrent writers like !puzzle's temp_answer).
+        # The staged copy is only dropped once history has the posts, so a
+        # restart in between can't lose them.
         now = datetime.now(timezone.utc).isoformat()
         fact["date"] = now
         whatif["date"] = now
-        async with HISTORY_LOCK:
-            history = load_history()
-            add_to_history(history, fact)
-            add_to_history(history, whatif)
+        if fact.get("summary") and whatif.get("summary"):
+            await history_repo.append_many([fact, whatif])
+            await history_repo.clear_staged_digest()
+        else:
+            # Summarize in the background; the post itself is already out
+            summary_queue.submit([fact, whatif], on_commit=history_repo.clear_staged_digest)
 
     except anthropic.APIError as e:
         logger.error(f"API error during weekly post: {e}")
@@ -540,6 +3096,7 @@ async def help_command(ctx):
         value=(
             "`!schedule` — Show posting schedule\n"
             "`!history [n]` — Show last n posts\n"
+            "`!archive [topic]` — Search older, archived posts\n"
             "`!help` — This message"
         ),
         inline=False
@@ -548,38 +3105,87 @@ async def help_command(ctx):
     await ctx.send(embed=embed)
 
 
+def on_demand(kind: str):
+    """Command decorator: meter its model calls as `kind` and queue them as
+    on-demand calls on behalf of the invoking user."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(ctx, *args, **kwargs):
+            with usage_ledger.request(kind), \
+                    model_scheduler.request(PRIORITY_ON_DEMAND, user=ctx.author.id):
+                return await func(ctx, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Queue notices are sent fire-and-forget; keep a reference until each is done.
+_notice_tasks = set()
+
+
+def _queue_notice(ctx):
+    """notify callback for model_scheduler that tells the user once that they're queued."""
+    sent = False
+
+    def notify(position: int) -> None:
+        nonlocal sent
+        if not sent:
+            sent = True
+            task = asyncio.create_task(ctx.send(f"Busy right now, you're #{position} in line..."))
+            _notice_tasks.add(task)
+            task.add_done_callback(_notice_tasks.discard)
+    return notify
+
+
+def _placeholder_embed(title: str, color: int, ctx) -> discord.Embed:
+    """Embed shown while an on-demand command's text is still streaming."""
+    embed = discord.Embed(
+        title=title,
+        description="Thinking..." + STREAM_CURSOR,
+        color=color,
+        timestamp=datetime.now(timezone.utc)
+    )
+    embed.set_footer(text=f"Requested by {ctx.author.display_name}")
+    return embed
+
+
 @bot.command(name="fact")
 @commands.cooldown(1, 30, commands.BucketType.user)
+@on_demand("!fact")
 async def get_fact(ctx, *, topic: str = None):
     """Get a fact on demand. Optionally specify a topic."""
     async with ctx.typing():
         try:
-            history = load_history()
+            history = await history_repo.view()
 
             if topic:
                 # Sanitize topic (basic length limit)
                 topic = topic[:100]
-                prompt = f"""Share a genuinely surprising fact about {topic}.
-
-Requirements:
-- Lead with the surprise—the thing that breaks intuition
-- Include a vivid analogy
-- Connect to everyday experience if possible
-- End with a question or "notice this next time..."
-- 3-5 sentences
-- No preamble
-- Close with one emoji"""
-
-                content = await call_claude(GENERATION_MODEL, 1024, prompt)
-                used_topic = topic
+                content = topic_cache.get(topic)
+                if content is None:
+                    embed = _placeholder_embed(f"Fact: {topic.title()}", 0x5865F2, ctx)
+                    async with StreamingEmbed(ctx, embed) as live:
+                        content = await single_flight.run(
+                            flight_key(topic),
+                            lambda publish: generate_topic_fact(topic, on_text=publish),
+                            live.update,
+                        )
+                        embed.description = truncate_for_embed(content)
+                    topic_cache.add(topic, content)
+                    return
+                result = {"content": content, "topic": topic}
             else:
-                result = await generate_fact(history)
-                content = result["content"]
-                used_topic = result.get("topic", "Physics & Math")
+                result = content_pool.take("fact", history)
+            if result is None:
+                embed = _placeholder_embed("Fact", 0x5865F2, ctx)
+                async with StreamingEmbed(ctx, embed) as live:
+                    result = await generate_fact(history, on_text=live.update)
+                    embed.title = f"Fact: {result.get('topic', 'Physics & Math').title()}"
+                    embed.description = truncate_for_embed(result["content"])
+                return
 
             embed = discord.Embed(
-                title=f"Fact: {used_topic.title()}",
-                description=truncate_for_embed(content),
+                title=f"Fact: {result.get('topic', 'Physics & Math').title()}",
+                description=truncate_for_embed(result["content"]),
                 color=0x5865F2,
                 timestamp=datetime.now(timezone.utc)
             )
@@ -593,12 +3199,19 @@ Requirements:
 
 @bot.command(name="whatif")
 @commands.cooldown(1, 30, commands.BucketType.user)
+@on_demand("!whatif")
 async def get_what_if(ctx):
     """Get an absurd hypothetical answered with real physics."""
     async with ctx.typing():
         try:
-            history = load_history()
-            result = await generate_what_if(history)
+            history = await history_repo.view()
+            result = content_pool.take("what_if", history)
+            if result is None:
+                embed = _placeholder_embed("What If...?", 0xEB459E, ctx)
+                async with StreamingEmbed(ctx, embed) as live:
+                    result = await generate_what_if(history, on_text=live.update)
+                    embed.description = truncate_for_embed(result["content"])
+                return
 
             embed = discord.Embed(
                 title="What If...?",
@@ -614,31 +3227,87 @@ async def get_what_if(ctx):
             await ctx.send("Sorry, I couldn't generate a what-if right now. Please try again later.")
 
 
+# Answer for the last !puzzle that is still being generated. !answer waits
+# for it; a newer !puzzle replaces it.
+_pending_answer = {"task": None}
+
+
+def _puzzle_embed(ctx, puzzle: dict) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Puzzle: {puzzle.get('topic', 'Math & Physics').title()}",
+        description=truncate_for_embed(puzzle["content"]),
+        color=0xFEE75C,
+        timestamp=datetime.now(timezone.utc)
+    )
+    embed.set_footer(text=f"Requested by {ctx.author.display_name} • Use !answer for solution")
+    return embed
+
+
+async def _store_puzzle_answer(generation: asyncio.Task, posted: asyncio.Future,
+                               embed: discord.Embed, shown: str) -> None:
+    """Wait for the rest of a streamed puzzle, then store its answer.
+
+    This task is registered before the puzzle is sent, so an !answer that
+    races the send waits for it instead of returning the previous answer.
+    posted resolves to the sent message (None if sending failed).
+    """
+    result = None
+    answer = "(Answer not available)"
+    try:
+        result = await generation
+        answer = result.get("answer", "No answer available")
+    except anthropic.APIError as e:
+        logger.error(f"Puzzle answer generation failed: {e}")
+    except Exception:
+        logger.exception("Puzzle answer generation failed")
+    if _pending_answer["task"] is asyncio.current_task():
+        await history_repo.set_field("temp_answer", answer)
+
+    message = await posted
+    if result is not None and message is not None and result["content"] != shown:
+        # A retry regenerated the puzzle after the first one was posted
+        embed.description = truncate_for_embed(result["content"])
+        await message.edit(embed=embed)
+
+
 @bot.command(name="puzzle")
 @commands.cooldown(1, 30, commands.BucketType.user)
+@on_demand("!puzzle")
 async def get_puzzle(ctx):
     """Get a puzzle."""
     async with ctx.typing():
         try:
-            history = load_history()
-            result = await generate_puzzle(history)
-
-            embed = discord.Embed(
-                title=f"Puzzle: {result.get('topic', 'Math & Physics').title()}",
-                description=truncate_for_embed(result["content"]),
-                color=0xFEE75C,
-                timestamp=datetime.now(timezone.utc)
+            history = await history_repo.view()
+            result = content_pool.take("puzzle", history)
+            if result is not None:
+                _pending_answer["task"] = None
+                # Store answer temporarily
+                await history_repo.set_field("temp_answer", result.get("answer", "No answer available"))
+                await ctx.send(embed=_puzzle_embed(ctx, result))
+                return
+
+            # Post the puzzle as soon as the stream reaches ANSWER:, and let
+            # the answer finish in the background.
+            announced = asyncio.get_running_loop().create_future()
+            with model_scheduler.notifying(_queue_notice(ctx)):
+                generation = asyncio.create_task(generate_puzzle(
+                    history, on_puzzle=lambda puzzle: announced.done() or announced.set_result(puzzle)
+                ))
+            await asyncio.wait({announced, generation}, return_when=asyncio.FIRST_COMPLETED)
+            if not announced.done():
+                generation.result()  # Raises the generation error
+            puzzle = announced.result()
+
+            embed = _puzzle_embed(ctx, puzzle)
+            posted = asyncio.get_running_loop().create_future()
+            _pending_answer["task"] = asyncio.create_task(
+                _store_puzzle_answer(generation, posted, embed, puzzle["content"])
             )
-            embed.set_footer(text=f"Requested by {ctx.author.display_name} • Use !answer for solution")
-
-            # Store answer temporarily (re-load under lock so we don't
-            # clobber a concurrent weekly-post write).
-            async with HISTORY_LOCK:
-                history = load_history()
-                history["temp_answer"] = result.get("answer", "No answer available")
-                save_history(history)
-
-            await ctx.send(embed=embed)
+            try:
+                posted.set_result(await ctx.send(embed=embed))
+            finally:
+                if not posted.done():
+                    posted.set_result(None)
 
         except anthropic.APIError:
             await ctx.send("Sorry, I couldn't generate a puzzle right now. Please try again later.")
@@ -647,7 +3316,13 @@ async def get_puzzle(ctx):
 @bot.command(name="answer")
 async def get_answer(ctx):
     """Get the answer to the last !puzzle."""
-    history = load_history()
+    pending = _pending_answer["task"]
+    if pending is not None and not pending.done():
+        async with ctx.typing():
+            # Shielded so a cancelled command can't drop the answer
+            await asyncio.shield(pending)
+
+    history = await history_repo.view()
     answer = history.get("temp_answer", "No recent puzzle to answer! Use `!puzzle` first.")
 
     embed = discord.Embed(
@@ -664,8 +3339,8 @@ async def show_history(ctx, count: int = 5):
     # Limit count to reasonable range
     count = max(1, min(count, 20))
 
-    history = load_history()
-    recent = history.get("posts", [])[-count:]
+    history = await history_repo.view()
+    recent = _last_posts(history, count)
 
     if not recent:
         await ctx.send("No posting history yet!")
@@ -686,6 +3361,30 @@ async def show_history(ctx, count: int = 5):
     await ctx.send(embed=embed)
 
 
+@bot.command(name="archive")
+async def show_archive(ctx, *, topic: str = None):
+    """Search posts that have aged out of the live history. Usage: !archive [topic]"""
+    posts = await history_repo.search_archive(topic=topic[:100] if topic else None, limit=10)
+
+    if not posts:
+        await ctx.send("No archived posts found.")
+        return
+
+    lines = []
+    for post in posts:
+        date = post.get("date", "")[:10]
+        mode = post.get("mode", "fact")
+        topic_name = post.get("topic", "unknown")
+        lines.append(f"`{date}` **{mode}**: {topic_name}")
+
+    embed = discord.Embed(
+        title=f"Archived Posts{f' about {topic[:100]}' if topic else ''}",
+        description="\n".join(lines),
+        color=0x5865F2
+    )
+    await ctx.send(embed=embed)
+
+
 @bot.command(name="schedule")
 async def show_schedule(ctx):
     """Show the weekly posting schedule."""
@@ -705,8 +3404,9 @@ async def show_schedule(ctx):
 @bot.command(name="status")
 async def show_status(ctx):
     """Show bot status (for monitoring)."""
-    history = load_history()
-    post_count = len(history.get("posts", []))
+    history = await history_repo.view()
+    post_count = _post_count(history)
+    archived = await history_repo.archive_stats()
 
     embed = discord.Embed(
         title="Bot Status",
@@ -714,10 +3414,34 @@ async def show_status(ctx):
     )
     embed.add_field(name="Version", value=VERSION, inline=True)
     embed.add_field(name="Posts in History", value=str(post_count), inline=True)
+    embed.add_field(name="Archived Posts", value=str(archived["warm"] + archived["cold"]), inline=True)
+    embed.add_field(name="Claude API", value=api_breaker.describe(), inline=True)
+    embed.add_field(
+        name="Content Pool",
+        value=" · ".join(f"{mode} {content_pool.ready_count(mode)}" for mode in ContentPool.GENERATORS),
+        inline=True
+    )
+    embed.add_field(name="Model Queue", value=model_scheduler.describe(), inline=True)
+    embed.add_field(name="Topic Cache", value=topic_cache.describe(), inline=True)
     embed.add_field(name="Next Post", value="Friday 7pm UTC", inline=True)
     await ctx.send(embed=embed)
 
 
+@bot.command(name="usage")
+async def show_usage(ctx):
+    """Show model calls, tokens, estimated cost and latency per request kind."""
+    lines = usage_ledger.describe()
+    total = sum(t["cost"] for t in usage_ledger.totals.values())
+    embed = discord.Embed(
+        title="Model Usage (since start)",
+        description="\n".join(lines) if lines else "No model calls yet.",
+        color=0x5865F2
+    )
+    embed.add_field(name="Hedged Requests", value=hedger.describe(), inline=False)
+    embed.set_footer(text=f"Estimated total ${total:.4f} • {single_flight.coalesced} requests coalesced")
+    await ctx.send(embed=embed)
+
+
 # =============================================================================
 # ENTRY POINT
 # =============================================================================
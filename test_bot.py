@@ -3,11 +3,18 @@
 Run with: pytest test_bot.py -v
 """
 
+import asyncio
 import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import httpx
 import pytest
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Import the functions we want to test
 import bot
@@ -17,6 +24,22 @@ import bot
 # FIXTURES
 # =============================================================================
 
+@pytest.fixture(autouse=True)
+def fresh_scheduler():
+    """Give every test its own model scheduler with full rate-limit buckets."""
+    scheduler = bot.ModelScheduler(bot.API_REQUESTS_PER_MINUTE, bot.API_TOKENS_PER_MINUTE)
+    with patch.object(bot, 'model_scheduler', scheduler):
+        yield scheduler
+
+
+@pytest.fixture(autouse=True)
+def fresh_hedger():
+    """Give every test its own hedger, so latencies from other tests don't trigger hedges."""
+    hedger = bot.Hedger(bot.HEDGE_BUDGET, bot.HEDGE_WINDOW, bot.HEDGE_MIN_SAMPLES)
+    with patch.object(bot, 'hedger', hedger):
+        yield hedger
+
+
 @pytest.fixture
 def empty_history():
     """Return an empty history structure."""
@@ -99,6 +122,228 @@ class TestLoadHistory:
         assert result == {"posts": [], "used_wonders": [], "used_topics": []}
 
 
+class TestHistoryView:
+    """Tests for history_view() and the in-process history cache."""
+
+    def test_reuses_parsed_copy(self, temp_history_file, sample_history):
+        """Should not re-parse the file when nothing changed."""
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            first = bot.history_view()
+            with patch.object(bot.json, 'load', side_effect=AssertionError("re-parsed")):
+                second = bot.history_view()
+
+        assert first is second
+
+    def test_invalidates_when_file_changes(self, temp_history_file, sample_history):
+        """Should pick up writes made by something other than save_history()."""
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            assert len(bot.history_view()["posts"]) == 3
+            sample_history["posts"].append({"topic": "new", "mode": "fact"})
+            temp_history_file.write_text(json.dumps(sample_history, indent=2))
+            assert len(bot.history_view()["posts"]) == 4
+
+    def test_save_primes_cache(self, temp_history_file, sample_history):
+        """Should serve the just-saved history without reading the file back."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            bot.save_history(sample_history)
+            with patch.object(bot.json, 'load', side_effect=AssertionError("re-parsed")):
+                view = bot.history_view()
+
+        assert view["posts"][2]["topic"] == "cosmology"
+
+    def test_view_is_read_only(self, temp_history_file, sample_history):
+        """Should reject mutation of the shared view."""
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            view = bot.history_view()
+
+        with pytest.raises(TypeError):
+            view["temp_answer"] = "x"
+        with pytest.raises(TypeError):
+            view["posts"][0]["topic"] = "x"
+
+    def test_load_history_returns_independent_copy(self, temp_history_file, sample_history):
+        """Mutating load_history()'s result should not leak into the cache."""
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            history = bot.load_history()
+            history["posts"].append({"topic": "scratch"})
+            history["used_topics"].append("scratch")
+            view = bot.history_view()
+
+        assert len(view["posts"]) == 3
+        assert "scratch" not in view["used_topics"]
+        with pytest.raises(TypeError):
+            history["posts"][0]["topic"] = "changed"
+
+
+class TestHistoryViewIndex:
+    """Tests for the sorted date index on history views."""
+
+    @pytest.fixture
+    def shuffled_history(self):
+        """Posts spread over 40 days, out of date order, with a few bad dates."""
+        now = datetime.now(timezone.utc)
+        rng = random.Random(1)
+        posts = [
+            {
+                "date": (now - timedelta(days=rng.uniform(-1, 40))).isoformat(),
+                "mode": rng.choice(["fact", "what_if", "puzzle"]),
+                "topic": f"topic_{i}",
+                "summary": f"Summary {i}",
+            }
+            for i in range(200)
+        ]
+        posts[10]["date"] = "invalid-date"
+        del posts[20]["date"]
+        return {"posts": posts, "used_wonders": [], "used_topics": []}
+
+    def test_recent_posts_match_scan(self, shuffled_history):
+        """Bisect lookups should return exactly what the list scan returns."""
+        view = bot._freeze_history(shuffled_history)
+        for days in (0, 1, 7, 14, 30, 60):
+            assert bot.get_recent_posts(view, days) == bot.get_recent_posts(shuffled_history, days)
+        assert bot.build_context_block(view) == bot.build_context_block(shuffled_history)
+
+    def test_callback_window_filters_mode(self, shuffled_history):
+        """Callback candidates should be facts 7-21 days old."""
+        view = bot._freeze_history(shuffled_history)
+        now = datetime.now(timezone.utc)
+        for _ in range(20):
+            post = bot.get_callback_candidate(view)
+            assert post["mode"] == "fact"
+            days_ago = (now - datetime.fromisoformat(post["date"])).days
+            assert 7 <= days_ago <= 21
+
+    def test_unknown_mode_returns_nothing(self, shuffled_history):
+        """Should return an empty list for a mode with no posts."""
+        view = bot._freeze_history(shuffled_history)
+        assert view.posts_between(None, None, mode="connections") == []
+
+    @pytest.mark.slow
+    def test_bisect_beats_scan_on_large_history(self):
+        """Indexed windowed queries should be much faster than scanning 10k posts."""
+        import bench_history
+        scan, indexed = bench_history.time_queries(10_000, repeat=5)
+        assert indexed * 5 < scan
+
+
+class TestPost:
+    """Tests for the Post record type."""
+
+    def test_round_trips_to_same_json(self, temp_history_file, sample_history):
+        """Loading and saving should reproduce the file byte for byte."""
+        sample_history["posts"][0]["extra_field"] = {"nested": [1, 2]}
+        sample_history["posts"][1] = dict(reversed(list(sample_history["posts"][1].items())))
+        original = json.dumps(sample_history, indent=2)
+        temp_history_file.write_text(original)
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            history = bot.load_history()
+            assert all(isinstance(post, bot.Post) for post in history["posts"])
+            bot.save_history(history)
+
+        assert temp_history_file.read_text() == original
+
+    def test_interns_against_tables(self):
+        """Repeated field values should share the TOPICS/WONDER_TYPES strings."""
+        data = json.loads(json.dumps({"topic": bot.TOPICS[3], "wonder_type": bot.WONDER_TYPES[2], "mode": "fact"}))
+        post = bot.Post.from_dict(data)
+
+        assert post["topic"] is bot.TOPICS[3]
+        assert post["wonder_type"] is bot.WONDER_TYPES[2]
+
+    def test_behaves_like_read_only_dict(self):
+        """Should support mapping access and compare equal to its dict."""
+        data = {"mode": "fact", "topic": "topology", "custom": 1}
+        post = bot.Post.from_dict(data)
+
+        assert post == data
+        assert post.get("summary", "") == ""
+        assert "custom" in post and "summary" not in post
+        with pytest.raises(KeyError):
+            post["summary"]
+        with pytest.raises(TypeError):
+            post["topic"] = "x"
+
+    @pytest.mark.slow
+    def test_uses_less_memory_than_dicts(self):
+        """Loaded posts should take noticeably less memory than plain dicts."""
+        import bench_history
+        dict_bytes, post_bytes = bench_history.post_memory(5_000)
+        assert post_bytes < dict_bytes * 0.8
+
+
+class TestBlobStore:
+    """Tests for out-of-line, content-addressed post bodies."""
+
+    def test_snapshot_keeps_only_content_ref(self, temp_history_file, empty_history):
+        """Saved posts should reference their body by hash instead of inlining it."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            bot.add_to_history(empty_history, {"mode": "fact", "topic": "topology", "content": "Donuts are mugs."})
+
+        stored = json.loads(temp_history_file.read_text())["posts"][0]
+        assert "content" not in stored
+        assert list(stored) == ["mode", "topic", "content_ref"]
+        blob = temp_history_file.with_name(temp_history_file.stem + "_blobs") / stored["content_ref"][:2] / stored["content_ref"]
+        assert blob.read_text() == "Donuts are mugs."
+
+    def test_identical_bodies_are_deduplicated(self, temp_history_file, empty_history):
+        """Posts with the same body should share one blob."""
+        posts = [{"mode": "fact", "topic": f"t{i}", "content": "Same body."} for i in range(3)]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            bot.add_many_to_history(empty_history, posts)
+
+        blob_dir = temp_history_file.with_name(temp_history_file.stem + "_blobs")
+        assert len([p for p in blob_dir.rglob("*") if p.is_file()]) == 1
+
+    def test_body_loaded_only_on_access(self, temp_history_file, empty_history):
+        """Metadata readers should never touch the blob store."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            bot.add_to_history(empty_history, {"mode": "fact", "topic": "topology", "summary": "s",
+                                               "content": "Donuts are mugs."})
+            bot._history_cache["key"] = None
+            with patch.object(bot, 'get_blob', wraps=bot.get_blob) as get_blob:
+                view = bot.history_view()
+                bot.build_context_block(view)
+                assert "content" in view["posts"][0]
+                assert get_blob.call_count == 0
+                assert view["posts"][0]["content"] == "Donuts are mugs."
+                assert get_blob.call_count == 1
+
+    def test_legacy_inline_content_is_moved_on_save(self, temp_history_file, sample_history):
+        """Existing files with inline bodies should load, and be externalized on the next save."""
+        sample_history["posts"][0]["content"] = "Inline body."
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            history = bot.load_history()
+            assert history["posts"][0]["content"] == "Inline body."
+            bot.save_history(history)
+            assert bot.load_history()["posts"][0]["content"] == "Inline body."
+
+        assert "Inline body." not in temp_history_file.read_text()
+
+    def test_sqlite_stores_bodies_in_blob_table(self, temp_history_file, empty_history):
+        """The sqlite backend should keep bodies in its blobs table."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'HISTORY_BACKEND', "sqlite"), \
+                patch.object(bot, 'HISTORY_DB', None):
+            bot.add_to_history(empty_history, {"mode": "fact", "topic": "topology", "content": "Donuts are mugs."})
+            conn = bot._history_db()
+            data = json.loads(conn.execute("SELECT data FROM posts").fetchone()[0])
+            assert "content" not in data
+            assert bot.history_view().last_posts(1)[0]["content"] == "Donuts are mugs."
+            conn.close()
+            bot._history_db_conns.clear()
+
+
 class TestSaveHistory:
     """Tests for save_history()."""
 
@@ -166,6 +411,16 @@ class TestAddToHistory:
         assert empty_history["posts"][0]["topic"] == "topic_2"
         assert empty_history["posts"][2]["topic"] == "topic_4"
 
+    def test_archives_pruned_posts(self, temp_history_file, empty_history):
+        """Pruned posts should move to the archive instead of being discarded."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            with patch.object(bot, 'MAX_HISTORY_POSTS', 3):
+                for i in range(5):
+                    bot.add_to_history(empty_history, {"topic": f"topic_{i}", "mode": "fact"})
+            archived = bot.search_archive()
+
+        assert [p["topic"] for p in archived] == ["topic_1", "topic_0"]
+
     def test_limits_used_wonders_memory(self, temp_history_file, empty_history):
         """Should limit used_wonders to RECENT_WONDERS_MEMORY."""
         with patch.object(bot, 'HISTORY_FILE', temp_history_file):
@@ -187,6 +442,436 @@ class TestAddToHistory:
         assert empty_history["used_topics"] == ["topic_2", "topic_3", "topic_4"]
 
 
+class TestAddManyToHistory:
+    """Tests for add_many_to_history() and history transactions."""
+
+    def test_persists_once(self, temp_history_file, empty_history):
+        """Should write the file once for several posts."""
+        posts = [{"topic": f"topic_{i}", "mode": "fact", "wonder_type": f"wonder_{i}"} for i in range(4)]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'save_history', wraps=bot.save_history) as save:
+            bot.add_many_to_history(empty_history, posts)
+
+        assert save.call_count == 1
+        assert len(json.loads(temp_history_file.read_text())["posts"]) == 4
+
+    def test_trims_like_individual_adds(self, tmp_path):
+        """Batching should leave the same history as adding one by one."""
+        posts = [{"topic": f"topic_{i}", "mode": "fact", "wonder_type": f"wonder_{i}"} for i in range(6)]
+        batched, single = bot._empty_history(), bot._empty_history()
+        with patch.object(bot, 'MAX_HISTORY_POSTS', 4), \
+                patch.object(bot, 'RECENT_TOPICS_MEMORY', 3):
+            with patch.object(bot, 'HISTORY_FILE', tmp_path / "batched.json"):
+                bot.add_many_to_history(batched, posts)
+            with patch.object(bot, 'HISTORY_FILE', tmp_path / "single.json"):
+                for post in posts:
+                    bot.add_to_history(single, post)
+
+        assert batched == single
+        assert batched["used_topics"] == ["topic_3", "topic_4", "topic_5"]
+
+    def test_jsonl_appends_in_one_write(self, temp_history_file, empty_history):
+        """Should append every post to the log with a single write call."""
+        posts = [{"topic": "a", "mode": "fact"}, {"topic": "b", "mode": "what_if"}]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'HISTORY_BACKEND', "jsonl"):
+            bot.add_many_to_history(empty_history, posts)
+            assert [p["topic"] for p in bot._read_history_file()["posts"]] == ["a", "b"]
+
+        assert len(temp_history_file.with_suffix(".log").read_text().splitlines()) == 2
+
+    async def test_transaction_commits_on_exit(self, temp_history_file):
+        """Should persist all posts and fields together when the block exits."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'save_history', wraps=bot.save_history) as save:
+            async with bot.history_repo.transaction() as txn:
+                txn.add({"topic": "a", "mode": "fact"})
+                txn.add({"topic": "b", "mode": "what_if"})
+                txn.set("temp_answer", "42")
+            history = await bot.history_repo.load()
+
+        assert save.call_count == 1
+        assert len(history["posts"]) == 2
+        assert history["temp_answer"] == "42"
+
+    async def test_transaction_discarded_on_error(self, temp_history_file):
+        """Should write nothing if the block raises."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            with pytest.raises(RuntimeError):
+                async with bot.history_repo.transaction() as txn:
+                    txn.add({"topic": "a", "mode": "fact"})
+                    raise RuntimeError("boom")
+
+        assert not temp_history_file.exists()
+
+
+class TestArchive:
+    """Tests for the warm/cold history archive."""
+
+    @pytest.fixture(autouse=True)
+    def small_tiers(self, temp_history_file):
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'MAX_HISTORY_POSTS', 2), \
+                patch.object(bot, 'ARCHIVE_SEGMENT_POSTS', 3):
+            yield
+
+    def _add_posts(self, count):
+        now = datetime.now(timezone.utc)
+        history = bot._empty_history()
+        for i in range(count):
+            bot.add_to_history(history, {
+                "date": (now - timedelta(days=count - i)).isoformat(),
+                "mode": "fact" if i % 2 == 0 else "what_if",
+                "topic": f"topic_{i}",
+            })
+        return history
+
+    def test_torn_warm_line_is_skipped(self, temp_history_file):
+        """A line cut short by a crash shouldn't break later writes or searches."""
+        self._add_posts(3)  # 1 archived to warm
+        warm_file = temp_history_file.with_name(temp_history_file.stem + "_archive") / "warm.jsonl"
+        with open(warm_file, "a") as f:
+            f.write('{"topic": "torn", "mo')
+
+        self._add_posts(5)  # seals a segment through the torn line
+
+        topics = {post["topic"] for post in bot.search_archive()}
+        assert "torn" not in topics
+        assert {"topic_0", "topic_1", "topic_2"} <= topics
+
+    def test_orphan_segment_is_not_overwritten(self, temp_history_file):
+        """A segment left unindexed by a crash should be kept, not overwritten."""
+        archive_dir = temp_history_file.with_name(temp_history_file.stem + "_archive")
+        archive_dir.mkdir()
+        orphan = archive_dir / "segment-00001.jsonl.gz"
+        orphan.write_bytes(b"orphan")
+
+        self._add_posts(5)  # 3 archived: seals one segment
+
+        assert orphan.read_bytes() == b"orphan"
+        assert bot._read_archive_index(archive_dir)["segments"][0]["file"] == "segment-00002.jsonl.gz"
+        assert {post["topic"] for post in bot.search_archive()} == {"topic_0", "topic_1", "topic_2"}
+
+    def test_index_written_before_warm_file_dropped(self, temp_history_file):
+        """A crash right after sealing should leave the segment indexed."""
+        real_unlink = Path.unlink
+
+        def crash_on_warm(path, *args, **kwargs):
+            if path.name == "warm.jsonl":
+                raise OSError("crashed")
+            return real_unlink(path, *args, **kwargs)
+
+        with patch.object(Path, 'unlink', crash_on_warm), pytest.raises(OSError):
+            self._add_posts(5)
+
+        assert bot.archive_stats() == {"warm": 0, "cold": 3, "segments": 1}
+
+    def test_archived_bodies_are_inlined(self, temp_history_file):
+        """Archived posts should keep their body in the archive and free the blob."""
+        history = bot._empty_history()
+        for i in range(3):
+            bot.add_to_history(history, {"mode": "fact", "topic": f"topic_{i}", "content": f"Body {i}."})
+
+        blob_dir = temp_history_file.with_name(temp_history_file.stem + "_blobs")
+        warm_file = temp_history_file.with_name(temp_history_file.stem + "_archive") / "warm.jsonl"
+        assert json.loads(warm_file.read_text())["content"] == "Body 0."
+        assert len([p for p in blob_dir.rglob("*") if p.is_file()]) == 2
+        assert bot.search_archive()[0]["content"] == "Body 0."
+
+    def test_shared_blob_kept_while_live(self, temp_history_file):
+        """A blob should survive archiving while a live post has the same body."""
+        history = bot._empty_history()
+        for i in range(3):
+            bot.add_to_history(history, {"mode": "fact", "topic": f"topic_{i}", "content": "Same body."})
+
+        assert [post["content"] for post in bot.load_history()["posts"]] == ["Same body."] * 2
+
+    def test_seals_cold_segments(self, temp_history_file):
+        """Should gzip the warm tier into a segment once it is full."""
+        self._add_posts(9)  # 7 archived: two 3-post segments plus 1 warm
+
+        archive_dir = temp_history_file.with_name(temp_history_file.stem + "_archive")
+        assert sorted(p.name for p in archive_dir.glob("*.gz")) == [
+            "segment-00001.jsonl.gz", "segment-00002.jsonl.gz",
+        ]
+        assert bot.archive_stats() == {"warm": 1, "cold": 6, "segments": 2}
+
+    def test_search_spans_tiers_newest_first(self):
+        """Should search warm and cold tiers, newest first."""
+        self._add_posts(9)
+
+        topics = [p["topic"] for p in bot.search_archive()]
+        assert topics == [f"topic_{i}" for i in range(6, -1, -1)]
+        assert [p["topic"] for p in bot.search_archive(mode="fact", limit=2)] == ["topic_6", "topic_4"]
+        assert [p["topic"] for p in bot.search_archive(topic="TOPIC_3")] == ["topic_3"]
+
+    def test_date_bounded_search_skips_segments(self):
+        """Segments outside the date range should not be opened."""
+        self._add_posts(9)
+        since = datetime.now(timezone.utc) - timedelta(days=3.5)
+
+        with patch.object(bot.gzip, 'open', side_effect=AssertionError("opened cold segment")):
+            assert [p["topic"] for p in bot.search_archive(since=since)] == ["topic_6"]
+
+    def test_live_history_stays_bounded(self):
+        """The hot tier should keep only MAX_HISTORY_POSTS posts."""
+        history = self._add_posts(9)
+        assert [p["topic"] for p in history["posts"]] == ["topic_7", "topic_8"]
+
+
+class TestJsonlBackend:
+    """Tests for the append-only write-ahead log history backend."""
+
+    @pytest.fixture(autouse=True)
+    def jsonl_backend(self, temp_history_file):
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'HISTORY_BACKEND', "jsonl"):
+            yield
+
+    def test_append_does_not_rewrite_snapshot(self, temp_history_file, sample_history):
+        """Should append to the log and leave the snapshot untouched."""
+        bot.save_history(sample_history)
+        snapshot = temp_history_file.read_text()
+
+        bot.add_to_history(sample_history, {"topic": "topology", "mode": "fact"})
+
+        assert temp_history_file.read_text() == snapshot
+        log_lines = temp_history_file.with_suffix(".log").read_text().splitlines()
+        assert len(log_lines) == 1
+        assert json.loads(log_lines[0])["post"]["topic"] == "topology"
+
+    def test_replays_log_on_load(self, temp_history_file, sample_history):
+        """Should rebuild history from snapshot plus log tail."""
+        bot.save_history(sample_history)
+        bot.add_to_history(sample_history, {"topic": "topology", "mode": "fact"})
+        bot.set_history_field(sample_history, "temp_answer", "42")
+
+        result = bot._read_history_file()
+
+        assert len(result["posts"]) == 4
+        assert result["posts"][-1]["topic"] == "topology"
+        assert result["used_topics"][-1] == "topology"
+        assert result["temp_answer"] == "42"
+
+    def test_compaction_folds_log_into_snapshot(self, temp_history_file, empty_history):
+        """Should rewrite the snapshot and drop the log once it grows too large."""
+        with patch.object(bot, 'HISTORY_LOG_MAX_BYTES', 200):
+            for i in range(5):
+                bot.add_to_history(empty_history, {"topic": f"topic_{i}", "mode": "fact"})
+
+        snapshot = json.loads(temp_history_file.read_text())
+        log_file = temp_history_file.with_suffix(".log")
+        log_posts = len(log_file.read_text().splitlines()) if log_file.exists() else 0
+        assert len(snapshot["posts"]) + log_posts == 5
+        assert len(bot._read_history_file()["posts"]) == 5
+
+    def test_skips_records_already_in_snapshot(self, temp_history_file, empty_history):
+        """A crash between snapshot write and log removal should not duplicate posts."""
+        bot.add_to_history(empty_history, {"topic": "topology", "mode": "fact"})
+        stale_log = temp_history_file.with_suffix(".log").read_text()
+        bot.compact_history()
+        temp_history_file.with_suffix(".log").write_text(stale_log)
+
+        assert len(bot._read_history_file()["posts"]) == 1
+
+    def test_ignores_torn_final_line(self, temp_history_file, empty_history):
+        """Should skip a partially written last record."""
+        bot.add_to_history(empty_history, {"topic": "topology", "mode": "fact"})
+        with open(temp_history_file.with_suffix(".log"), "a") as f:
+            f.write('{"op": "post", "po')
+
+        assert len(bot._read_history_file()["posts"]) == 1
+
+
+class TestSqliteBackend:
+    """Tests for the sqlite history backend."""
+
+    @pytest.fixture(autouse=True)
+    def sqlite_backend(self, temp_history_file):
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'HISTORY_BACKEND', "sqlite"), \
+                patch.object(bot, 'HISTORY_DB', None):
+            yield
+        for conn in bot._history_db_conns.values():
+            conn.close()
+        bot._history_db_conns.clear()
+
+    def test_migrates_existing_json_file(self, temp_history_file, sample_history):
+        """Should import the JSON history the first time the database is opened."""
+        sample_history["temp_answer"] = "42"
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        history = bot.load_history()
+
+        assert [p["topic"] for p in history["posts"]] == ["quantum mechanics", "thermodynamics", "cosmology"]
+        assert history["used_topics"] == sample_history["used_topics"]
+        assert history["temp_answer"] == "42"
+        assert temp_history_file.with_suffix(".db").exists()
+
+    def test_migration_runs_once(self, temp_history_file, sample_history):
+        """Should not re-import the JSON file into a database that has been used."""
+        temp_history_file.write_text(json.dumps(sample_history))
+        bot.history_view()
+        for conn in bot._history_db_conns.values():
+            conn.close()
+        bot._history_db_conns.clear()
+        bot._history_cache["key"] = None
+
+        sample_history["posts"].append({"topic": "late", "mode": "fact"})
+        temp_history_file.write_text(json.dumps(sample_history))
+
+        assert bot.history_view().post_count() == 3
+
+    def test_add_to_history_is_not_capped(self, empty_history):
+        """Should keep every post instead of pruning at MAX_HISTORY_POSTS."""
+        with patch.object(bot, 'MAX_HISTORY_POSTS', 3):
+            for i in range(5):
+                bot.add_to_history(empty_history, {"topic": f"topic_{i}", "mode": "fact"})
+
+        view = bot.history_view()
+        assert view.post_count() == 5
+        assert [p["topic"] for p in view.last_posts(2)] == ["topic_3", "topic_4"]
+        assert list(view["used_topics"]) == [f"topic_{i}" for i in range(5)]
+
+    def test_queries_match_in_memory_results(self, sample_history):
+        """Indexed queries should return the same posts as the list scans."""
+        now = datetime.now(timezone.utc)
+        sample_history["posts"] += [
+            {"date": (now - timedelta(days=10)).isoformat(), "mode": "fact", "topic": f"t{i}"}
+            for i in range(5)
+        ]
+        sample_history["posts"].append({"topic": "no-date", "mode": "fact"})
+        bot.save_history(sample_history)
+        view = bot.history_view()
+
+        for days in (5, 7, 14):
+            assert bot.get_recent_posts(view, days) == bot.get_recent_posts(sample_history, days)
+        assert bot.build_context_block(view) == bot.build_context_block(sample_history)
+        expected = {"quantum mechanics", "thermodynamics"} | {f"t{i}" for i in range(5)}
+        for _ in range(10):
+            assert bot.get_callback_candidate(view)["topic"] in expected
+
+    def test_range_queries_use_index(self):
+        """Should answer date range queries from an index, not a table scan."""
+        conn = bot._history_db()
+        plan = " ".join(
+            row[-1] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT data FROM posts WHERE ts > ? AND mode = ?", (0, "fact")
+            )
+        )
+        assert "USING INDEX" in plan
+
+    def test_set_history_field(self, empty_history):
+        """Should persist top-level fields like temp_answer."""
+        bot.set_history_field(empty_history, "temp_answer", "42")
+        assert bot.history_view()["temp_answer"] == "42"
+
+    async def test_view_queries_run_on_history_thread(self, sample_history):
+        """Commands' queries on a view should be answered without touching sqlite."""
+        now = datetime.now(timezone.utc)
+        sample_history["posts"][0]["content"] = "Donuts are mugs."
+        sample_history["posts"] += [
+            {"date": (now - timedelta(days=10)).isoformat(), "mode": "fact", "topic": f"t{i}"}
+            for i in range(5)
+        ]
+        bot.save_history(sample_history)
+        view = await bot.history_repo.view()
+
+        with patch.object(bot, '_history_db_reader', side_effect=AssertionError("queried sqlite")), \
+                patch.object(bot, 'get_blob', side_effect=AssertionError("read a blob")):
+            assert bot.build_context_block(view)
+            assert bot.get_callback_candidate(view) is not None
+            assert len(bot._last_posts(view, 20)) == 8
+            assert bot._post_count(view) == 8
+            assert view.last_posts(8)[0]["content"] == "Donuts are mugs."
+
+
+class TestCrossProcessLocking:
+    """Tests for history writes from several processes at once."""
+
+    WRITER = (
+        "import sys, bot\n"
+        "for i in range(int(sys.argv[2])):\n"
+        "    bot.add_to_history(bot._empty_history(), {'mode': 'fact', 'topic': f'{sys.argv[1]}-{i}'})\n"
+    )
+
+    def test_stale_caller_copy_does_not_clobber(self, temp_history_file):
+        """Adding via an outdated dict should keep posts written since it was loaded."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            stale = bot.load_history()
+            bot.add_to_history(bot.load_history(), {"topic": "first", "mode": "fact"})
+            bot.add_to_history(stale, {"topic": "second", "mode": "fact"})
+
+            assert [p["topic"] for p in bot.load_history()["posts"]] == ["first", "second"]
+            assert [p["topic"] for p in stale["posts"]] == ["first", "second"]
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize("backend", ["json", "jsonl", "sqlite"])
+    def test_concurrent_processes_lose_no_posts(self, tmp_path, backend):
+        """Several processes hammering add_to_history should all be persisted."""
+        history_file = tmp_path / "shared_history.json"
+        env = {**os.environ, "HISTORY_FILE": str(history_file), "HISTORY_BACKEND": backend}
+        env.pop("HISTORY_DB", None)
+        writers, per_writer = 4, 25
+
+        procs = [
+            subprocess.Popen([sys.executable, "-c", self.WRITER, f"w{n}", str(per_writer)],
+                             env=env, cwd=Path(bot.__file__).parent,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for n in range(writers)
+        ]
+        for proc in procs:
+            _, err = proc.communicate(timeout=60)
+            assert proc.returncode == 0, err.decode()
+
+        with patch.object(bot, 'HISTORY_FILE', history_file), \
+                patch.object(bot, 'HISTORY_BACKEND', backend), \
+                patch.object(bot, 'HISTORY_DB', None):
+            topics = {p["topic"] for p in bot.load_history()["posts"]}
+            bot._history_db_conns.pop(str(history_file.with_suffix(".db")), None)
+
+        assert topics == {f"w{n}-{i}" for n in range(writers) for i in range(per_writer)}
+
+
+class TestHistoryRepository:
+    """Tests for the async HistoryRepository."""
+
+    async def test_io_runs_off_event_loop(self, temp_history_file):
+        """Should do file work on the dedicated history-io thread."""
+        threads = []
+        real_save = bot.save_history
+
+        def recording_save(history):
+            threads.append(threading.current_thread().name)
+            real_save(history)
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'save_history', recording_save):
+            await bot.history_repo.append({"topic": "topology", "mode": "fact"})
+
+        assert threads and all(name.startswith("history-io") for name in threads)
+
+    async def test_concurrent_writers_do_not_clobber(self, temp_history_file):
+        """Concurrent appends and field updates should all be persisted."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await asyncio.gather(
+                *(bot.history_repo.append({"topic": f"topic_{i}", "mode": "fact"}) for i in range(10)),
+                bot.history_repo.set_field("temp_answer", "42"),
+            )
+            history = await bot.history_repo.load()
+
+        assert len(history["posts"]) == 10
+        assert history["temp_answer"] == "42"
+
+    async def test_view_reflects_writes(self, temp_history_file):
+        """Should return the updated view after a write."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await bot.history_repo.append({"topic": "topology", "mode": "fact"})
+            view = await bot.history_repo.view()
+
+        assert view["posts"][0]["topic"] == "topology"
+
+
 # =============================================================================
 # CALLBACK CANDIDATE TESTS
 # =============================================================================
@@ -389,6 +1074,1228 @@ class TestBuildContextBlock:
         assert "topic_4" not in result
 
 
+# =============================================================================
+# CALL CLAUDE TESTS
+# =============================================================================
+
+def make_message(text: str, input_tokens: int = 100, output_tokens: int = 50) -> MagicMock:
+    """Build a minimal stand-in for an Anthropic Message."""
+    message = MagicMock()
+    message.content = [MagicMock(text=text)]
+    message.usage = MagicMock(input_tokens=input_tokens, output_tokens=output_tokens)
+    return message
+
+
+def make_tool_message(tool_input: dict) -> MagicMock:
+    """Build a stand-in for a Message whose only block is a submit_post tool call."""
+    block = MagicMock(type="tool_use", input=tool_input)
+    block.name = "submit_post"  # `name` is a MagicMock constructor argument
+    message = make_message("")
+    message.content = [block]
+    return message
+
+
+def make_status_error(status: int, headers: dict | None = None):
+    """Build an Anthropic status error as the SDK would raise it."""
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return bot.anthropic.APIStatusError(f"HTTP {status}", response=response, body=None)
+
+
+class FakeStream:
+    """Stand-in for the SDK's message stream, yielding chunks then optionally failing."""
+
+    def __init__(self, *chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        yield MagicMock(type="message_start", message=make_message("", output_tokens=1))
+        async for chunk in self.text_stream:
+            yield MagicMock(type="text", text=chunk)
+
+    @property
+    async def text_stream(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    async def get_final_message(self):
+        return make_message("".join(self.chunks))
+
+
+def make_ctx():
+    """Build a command context whose send() returns an editable message."""
+    ctx = MagicMock()
+    ctx.author.display_name = "tester"
+    ctx.message_sent = MagicMock()
+    ctx.message_sent.edit = AsyncMock()
+    ctx.message_sent.delete = AsyncMock()
+    ctx.send = AsyncMock(return_value=ctx.message_sent)
+    return ctx
+
+
+@pytest.fixture
+def fresh_breaker():
+    """Fresh circuit breaker and near-zero backoff for retry tests."""
+    breaker = bot.CircuitBreaker(threshold=3, cooldown=60)
+    with patch.object(bot, 'api_breaker', breaker), \
+            patch.object(bot, 'API_RETRY_BASE_DELAY', 0.001), \
+            patch.object(bot, 'API_RETRY_MAX_DELAY', 0.002):
+        yield breaker
+
+
+class TestCallClaude:
+    """Tests for call_claude()."""
+
+    @pytest.fixture(autouse=True)
+    def _breaker(self, fresh_breaker):
+        yield
+
+    async def test_returns_text(self):
+        """Should return the text of the first content block."""
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("hi"))) as create:
+            result = await bot.call_claude("model-x", 50, "prompt")
+
+        assert result == "hi"
+        assert create.call_args.kwargs["model"] == "model-x"
+        assert create.call_args.kwargs["messages"] == [{"role": "user", "content": "prompt"}]
+
+    async def test_concurrent_calls_do_not_use_threads(self):
+        """Calls should multiplex on the event loop, not the thread pool."""
+        in_flight, peak = 0, 0
+
+        async def slow_create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return make_message("ok")
+
+        # Concurrency is otherwise capped by the adaptive limit (see TestAdaptiveConcurrency)
+        scheduler = bot.ModelScheduler(bot.API_REQUESTS_PER_MINUTE, bot.API_TOKENS_PER_MINUTE, max_concurrency=50)
+        with patch.object(bot.claude.messages, 'create', side_effect=slow_create), \
+                patch.object(bot, 'model_scheduler', scheduler), \
+                patch.object(bot.asyncio, 'to_thread', side_effect=AssertionError("used a thread")):
+            results = await asyncio.gather(*(bot.call_claude("m", 10, "p") for _ in range(50)))
+
+        assert results == ["ok"] * 50
+        assert peak == 50
+
+    async def test_streams_accumulated_text(self):
+        """With on_text, should stream and report the text generated so far."""
+        seen = []
+        with patch.object(bot.claude.messages, 'stream', return_value=FakeStream("Hel", "lo", "!")):
+            result = await bot.call_claude("m", 10, "p", on_text=seen.append)
+
+        assert result == "Hello!"
+        assert seen == ["Hel", "Hello", "Hello!"]
+
+    async def test_stream_retry_starts_over(self):
+        """A stream that fails midway should be retried from the beginning."""
+        seen = []
+        streams = [FakeStream("Par", error=make_status_error(529)), FakeStream("Full ", "text")]
+        with patch.object(bot.claude.messages, 'stream', side_effect=streams):
+            result = await bot.call_claude("m", 10, "p", on_text=seen.append)
+
+        assert result == "Full text"
+        assert seen == ["Par", "Full ", "Full text"]
+
+    def test_client_is_async(self):
+        """Should use the SDK's native async client."""
+        assert isinstance(bot.claude, bot.anthropic.AsyncAnthropic)
+
+
+class TestRetries:
+    """Tests for the retry layer and circuit breaker around model calls."""
+
+    async def test_retries_transient_errors(self, fresh_breaker):
+        """Should retry a 529 and return the eventual success."""
+        create = AsyncMock(side_effect=[make_status_error(529), make_status_error(503), make_message("ok")])
+        with patch.object(bot.claude.messages, 'create', create):
+            assert await bot.call_claude("m", 10, "p") == "ok"
+
+        assert create.call_count == 3
+        assert fresh_breaker.state == "closed" and fresh_breaker.failures == 0
+
+    async def test_does_not_retry_client_errors(self, fresh_breaker):
+        """A 400 is the request's fault and should fail immediately."""
+        create = AsyncMock(side_effect=make_status_error(400))
+        with patch.object(bot.claude.messages, 'create', create):
+            with pytest.raises(bot.anthropic.APIStatusError):
+                await bot.call_claude("m", 10, "p")
+
+        assert create.call_count == 1
+
+    async def test_gives_up_after_max_attempts(self, fresh_breaker):
+        """Should re-raise once API_MAX_ATTEMPTS are used up."""
+        fresh_breaker.threshold = 100
+        create = AsyncMock(side_effect=make_status_error(529))
+        with patch.object(bot.claude.messages, 'create', create):
+            with pytest.raises(bot.anthropic.APIStatusError):
+                await bot.call_claude("m", 10, "p")
+
+        assert create.call_count == bot.API_MAX_ATTEMPTS
+
+    def test_honours_retry_after(self):
+        """Should wait exactly as long as the server asks."""
+        assert bot._retry_delay(1.0, make_status_error(429, {"retry-after": "7"})) == 7.0
+        assert bot._retry_delay(1.0, make_status_error(429, {"retry-after-ms": "250"})) == 0.25
+
+    def test_jitter_is_bounded(self):
+        """Decorrelated jitter should stay within [base, min(cap, 3 * previous)]."""
+        error = make_status_error(529)
+        for previous in (1.0, 5.0, 50.0):
+            for _ in range(50):
+                delay = bot._retry_delay(previous, error)
+                assert bot.API_RETRY_BASE_DELAY <= delay <= min(bot.API_RETRY_MAX_DELAY, previous * 3)
+
+    async def test_gives_up_when_retry_after_exceeds_deadline(self, fresh_breaker):
+        """Should not sleep past the per-call deadline."""
+        create = AsyncMock(side_effect=make_status_error(429, {"retry-after": "600"}))
+        with patch.object(bot.claude.messages, 'create', create):
+            with pytest.raises(bot.anthropic.APIStatusError):
+                await bot.call_claude("m", 10, "p")
+
+        assert create.call_count == 1
+
+    async def test_deadline_bounds_slow_calls(self, fresh_breaker):
+        """A hung call should be abandoned at the deadline."""
+        async def hang(**kwargs):
+            await asyncio.sleep(10)
+
+        with patch.object(bot.claude.messages, 'create', side_effect=hang), \
+                patch.object(bot, 'API_CALL_DEADLINE', 0.05):
+            with pytest.raises(bot.DeadlineExceededError):
+                await bot.call_claude("m", 10, "p")
+
+    async def test_breaker_opens_and_fails_fast(self, fresh_breaker):
+        """After repeated failures, calls should fail without hitting the API."""
+        create = AsyncMock(side_effect=make_status_error(529))
+        with patch.object(bot.claude.messages, 'create', create):
+            with pytest.raises(bot.anthropic.APIError):
+                await bot.call_claude("m", 10, "p")
+            calls = create.call_count
+            with pytest.raises(bot.CircuitOpenError):
+                await bot.call_claude("m", 10, "p")
+
+        assert calls == fresh_breaker.threshold
+        assert create.call_count == calls
+        assert fresh_breaker.describe().startswith("Unavailable")
+
+    async def test_breaker_half_open_trial(self, fresh_breaker):
+        """After the cooldown one trial call decides whether to close the circuit."""
+        for _ in range(fresh_breaker.threshold):
+            fresh_breaker.record_failure()
+        fresh_breaker.opened_at -= fresh_breaker.cooldown
+
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("ok"))):
+            assert await bot.call_claude("m", 10, "p") == "ok"
+
+        assert fresh_breaker.state == "closed"
+
+    async def test_cancelled_trial_frees_the_slot(self, fresh_breaker):
+        """A trial call that is cancelled shouldn't leave the circuit stuck half-open."""
+        for _ in range(fresh_breaker.threshold):
+            fresh_breaker.record_failure()
+        fresh_breaker.opened_at -= fresh_breaker.cooldown
+
+        async def hang(**kwargs):
+            await asyncio.sleep(10)
+
+        with patch.object(bot.claude.messages, 'create', side_effect=hang):
+            trial = asyncio.create_task(bot.call_claude("m", 10, "p"))
+            await asyncio.sleep(0.01)
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+        assert fresh_breaker.state == "half_open"
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("ok"))):
+            assert await bot.call_claude("m", 10, "p") == "ok"
+        assert fresh_breaker.state == "closed"
+
+
+# =============================================================================
+# CONTENT POOL TESTS
+# =============================================================================
+
+class TestContentPool:
+    """Tests for the pre-generated ContentPool."""
+
+    @pytest.fixture
+    def generators(self):
+        """Patch the generators to return numbered results without API calls."""
+        counter = {"n": 0}
+
+        def fake(mode):
+            async def generate(history):
+                counter["n"] += 1
+                return {"mode": mode, "content": f"{mode} {counter['n']}", "answer": "a"}
+            return generate
+
+        with patch.object(bot, 'generate_fact', fake("fact")), \
+                patch.object(bot, 'generate_what_if', fake("what_if")), \
+                patch.object(bot, 'generate_puzzle', fake("puzzle")):
+            yield counter
+
+    async def test_refill_fills_to_high_watermark(self, temp_history_file, generators):
+        """Should generate up to the high watermark for every mode."""
+        pool = bot.ContentPool(low=1, high=3)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await pool.refill()
+
+        assert {mode: pool.ready_count(mode) for mode in ("fact", "what_if", "puzzle")} == \
+            {"fact": 3, "what_if": 3, "puzzle": 3}
+
+    async def test_take_pops_ready_entries(self, temp_history_file, generators):
+        """Should hand out pooled entries in order, then report a miss."""
+        pool = bot.ContentPool(low=1, high=2)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await pool.refill()
+            history = bot.history_view()
+            first = pool.take("fact", history)
+            second = pool.take("fact", history)
+            third = pool.take("fact", history)
+
+        assert first["content"] == "fact 1" and second["content"] == "fact 2"
+        assert third is None
+        assert (pool.hits, pool.misses) == (2, 1)
+
+    async def test_stale_entries_are_discarded(self, temp_history_file, generators):
+        """Entries generated before the history changed should not be served."""
+        pool = bot.ContentPool(low=1, high=2)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await pool.refill()
+            bot.add_to_history(bot.load_history(), {
+                "date": datetime.now(timezone.utc).isoformat(),
+                "mode": "fact", "topic": "topology", "summary": "New post.",
+            })
+            assert pool.take("what_if", bot.history_view()) is None
+            await pool.refill()
+            assert pool.ready_count("what_if") == 2
+
+    async def test_refill_skips_modes_above_low_watermark(self, temp_history_file, generators):
+        """Should not generate for a mode that still has enough entries."""
+        pool = bot.ContentPool(low=1, high=2)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await pool.refill()
+            pool.take("fact", bot.history_view())
+            generated = generators["n"]
+            await pool.refill()
+
+        assert generators["n"] == generated
+        assert pool.ready_count("fact") == 1
+
+    async def test_refill_loop_survives_unexpected_errors(self, temp_history_file, generators):
+        """A non-API error should back off and retry, not end the background task."""
+        pool = bot.ContentPool(low=1, high=1)
+        real_refill = pool.refill
+        calls = []
+
+        async def flaky_refill():
+            calls.append(1)
+            if len(calls) == 1:
+                raise KeyError("content")
+            await real_refill()
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'POOL_ERROR_BACKOFF', 0.01), \
+                patch.object(pool, 'refill', flaky_refill):
+            pool.start()
+            for _ in range(100):
+                if pool.ready_count("puzzle"):
+                    break
+                await asyncio.sleep(0.01)
+            pool._task.cancel()
+
+        assert len(calls) >= 2
+        assert pool.ready_count("puzzle") == 1
+
+
+class FridayEvening(datetime):
+    """datetime whose now() is a Friday at posting time."""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2026, 10, 16, 19, 0, tzinfo=timezone.utc)
+
+
+class TestWeeklyDigest:
+    """Tests for ahead-of-time digest generation and weekly_post."""
+
+    @pytest.fixture
+    def digest(self):
+        """Patch generate_weekly_digest to return a fresh fact/what-if pair."""
+        mock = AsyncMock(side_effect=lambda history: (
+            {"mode": "fact", "topic": "topology", "content": "Fact body.", "summary": "Fact."},
+            {"mode": "what_if", "topic": "optics", "content": "What-if body.", "summary": "What if."},
+        ))
+        with patch.object(bot, 'generate_weekly_digest', mock):
+            yield mock
+
+    @pytest.fixture(autouse=True)
+    def queue(self):
+        with patch.object(bot, 'summary_queue', bot.SummaryQueue()) as queue:
+            yield queue
+
+    @pytest.fixture
+    def channel(self):
+        channel = MagicMock()
+        channel.send = AsyncMock()
+        with patch.object(bot.bot, 'get_channel', return_value=channel):
+            yield channel
+
+    async def test_stage_persists_once(self, temp_history_file, digest):
+        """Should stage the digest for the given date and not regenerate it."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await bot.stage_weekly_digest("2026-10-16")
+            await bot.stage_weekly_digest("2026-10-16")
+            staged = bot.load_staged_digest("2026-10-16")
+            other_day = bot.load_staged_digest("2026-10-23")
+
+        assert digest.await_count == 1
+        assert staged["fact"]["topic"] == "topology"
+        assert other_day is None
+
+    async def test_concurrent_staging_generates_once(self, temp_history_file, digest):
+        """A catch-up run racing the scheduled run should not generate twice."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, '_staging_lock', asyncio.Lock()):
+            await asyncio.gather(bot.stage_weekly_digest("2026-10-16"), bot.stage_weekly_digest("2026-10-16"))
+
+        assert digest.await_count == 1
+
+    async def test_catch_up_runs_once_per_process(self):
+        """Reconnects fire on_ready again; the catch-up run should not repeat."""
+        run = AsyncMock()
+        with patch.object(bot, 'pregenerate_digest', MagicMock(side_effect=run, is_running=lambda: True)), \
+                patch.object(bot, 'weekly_post', MagicMock(is_running=lambda: True)), \
+                patch.object(bot, '_digest_catch_up', {"task": None}), \
+                patch.object(bot.bot, 'change_presence', AsyncMock()), \
+                patch.object(bot.bot, '_connection', MagicMock()), \
+                patch.object(bot.history_repo, 'compact', AsyncMock()), \
+                patch.object(bot.content_pool, 'start'), \
+                patch.object(bot.summary_queue, 'start'):
+            await bot.on_ready()
+            await bot.on_ready()
+            await bot._digest_catch_up["task"]
+
+        assert run.await_count == 1
+
+    async def test_weekly_post_sends_staged_digest(self, temp_history_file, digest, channel, queue):
+        """Should post the staged digest without calling the model."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file):
+            await bot.stage_weekly_digest("2026-10-16")
+            digest.reset_mock()
+            with patch.object(bot, 'datetime', FridayEvening):
+                await bot.weekly_post()
+            await queue.join()
+            history = bot.load_history()
+            staged = bot.load_staged_digest("2026-10-16")
+
+        digest.assert_not_awaited()
+        channel.send.assert_awaited_once()
+        assert [post["topic"] for post in history["posts"]] == ["topology", "optics"]
+        assert staged is None
+        assert queue.pending() == 0  # Already summarized, so committed directly
+
+    async def test_staged_digest_kept_until_committed(self, temp_history_file, digest, channel, queue):
+        """If unsummarized posts fail to commit, the staged copy should survive."""
+        del digest.side_effect
+        digest.return_value = ({"mode": "fact", "topic": "topology", "content": "Fact body."},
+                               {"mode": "what_if", "topic": "optics", "content": "What-if body."})
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'generate_summary', AsyncMock(return_value="Summary.")):
+            bot.save_staged_digest("2026-10-16", *digest.return_value)
+            with patch.object(bot, 'datetime', FridayEvening), \
+                    patch.object(bot.history_repo, 'append_many', AsyncMock(side_effect=OSError("disk full"))):
+                await bot.weekly_post()
+                await queue.join()
+            staged = bot.load_staged_digest("2026-10-16")
+
+        channel.send.assert_awaited_once()
+        assert staged is not None
+
+    async def test_weekly_post_generates_live_with_retries(self, temp_history_file, digest, channel, queue):
+        """Should fall back to live generation and retry failed attempts."""
+        fallback = digest.side_effect
+        digest.side_effect = [make_status_error(529), fallback(None)]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'datetime', FridayEvening), \
+                patch.object(bot, 'DIGEST_LIVE_RETRY_DELAY', 0):
+            await bot.weekly_post()
+            await queue.join()
+            history = bot.load_history()
+
+        assert digest.await_count == 2
+        channel.send.assert_awaited_once()
+        assert len(history["posts"]) == 2
+
+
+class TestStreamingEmbed:
+    """Tests for StreamingEmbed and the streamed on-demand commands."""
+
+    @pytest.fixture(autouse=True)
+    def _fast_edits(self):
+        with patch.object(bot, 'STREAM_EDIT_INTERVAL', 0.05):
+            yield
+
+    async def test_edits_are_throttled(self):
+        """Rapid updates should collapse into a few edits showing the newest text."""
+        ctx = make_ctx()
+        shown = []
+        ctx.message_sent.edit.side_effect = lambda embed: shown.append(embed.description)
+        embed = bot.discord.Embed(title="t", description="...")
+        async with bot.StreamingEmbed(ctx, embed) as live:
+            for i in range(1, 21):
+                live.update("x" * i)
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(0.1)
+            embed.description = "final"
+
+        assert 2 <= len(shown) <= 5
+        assert shown[-2] == "x" * 20 + bot.STREAM_CURSOR
+        assert shown[-1] == "final"
+
+    async def test_placeholder_deleted_on_error(self):
+        """If generation fails, the placeholder should be removed."""
+        ctx = make_ctx()
+        with pytest.raises(bot.anthropic.APIError):
+            async with bot.StreamingEmbed(ctx, bot.discord.Embed(title="t")) as live:
+                live.update("partial")
+                raise make_status_error(500)
+
+        ctx.message_sent.delete.assert_awaited_once()
+
+    async def test_whatif_streams_on_pool_miss(self, temp_history_file, fresh_breaker):
+        """!whatif should send a placeholder, then edit in the finished text."""
+        ctx = make_ctx()
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'content_pool', bot.ContentPool(low=1, high=0)), \
+                patch.object(bot.claude.messages, 'stream', return_value=FakeStream("What if ", "Earth stopped?")):
+            await bot.get_what_if.callback(ctx)
+
+        placeholder = ctx.send.await_args.kwargs["embed"]
+        assert ctx.send.await_count == 1
+        assert placeholder.description == "What if Earth stopped?"
+        assert ctx.message_sent.edit.await_args.kwargs["embed"] is placeholder
+
+
+class GatedStream(FakeStream):
+    """FakeStream that pauses before the chunks after `gate_at` until released."""
+
+    def __init__(self, *chunks, gate_at):
+        super().__init__(*chunks)
+        self.gate_at = gate_at
+        self.release = asyncio.Event()
+
+    @property
+    async def text_stream(self):
+        for i, chunk in enumerate(self.chunks):
+            if i == self.gate_at:
+                await self.release.wait()
+            yield chunk
+
+
+class TestEarlyPuzzle:
+    """Tests for streaming !puzzle up to the ANSWER: marker."""
+
+    def test_splitter_finds_marker_across_chunks(self):
+        """Should detect a marker split between chunks, and report it once."""
+        found = []
+        splitter = bot.AnswerSplitter(found.append)
+        text = ""
+        for chunk in ["Why is the sky blue? 🤔\n\nANS", "WER: Rayleigh", " scattering."]:
+            text += chunk
+            splitter.feed(text)
+
+        assert found == ["Why is the sky blue? 🤔"]
+
+    async def test_puzzle_posted_before_answer_finishes(self, temp_history_file, fresh_breaker):
+        """The puzzle embed should go out while the answer is still streaming."""
+        ctx = make_ctx()
+        stream = GatedStream("Two trains... 🤔\n", "ANSWER:", " They never meet.", gate_at=2)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'content_pool', bot.ContentPool(low=1, high=0)), \
+                patch.object(bot.claude.messages, 'stream', return_value=stream):
+            await bot.get_puzzle.callback(ctx)
+            assert ctx.send.await_args.kwargs["embed"].description == "Two trains... 🤔"
+
+            stream.release.set()
+            answer_ctx = make_ctx()
+            await bot.get_answer.callback(answer_ctx)
+
+        assert answer_ctx.send.await_args.kwargs["embed"].description == "They never meet."
+
+    async def test_answer_during_send_waits_for_new_puzzle(self, temp_history_file, fresh_breaker):
+        """An !answer handled while the puzzle is still being sent shouldn't get the old answer."""
+        answer_ctx = make_ctx()
+        answering = []
+
+        async def send(**kwargs):
+            # The puzzle is visible before send() returns, so !answer can arrive now
+            answering.append(asyncio.create_task(bot.get_answer.callback(answer_ctx)))
+            await asyncio.sleep(0.01)
+
+        ctx = make_ctx()
+        ctx.send.side_effect = send
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'content_pool', bot.ContentPool(low=1, high=0)), \
+                patch.object(bot.claude.messages, 'stream', return_value=FakeStream("Riddle?\nANSWER: New.")):
+            await bot.history_repo.set_field("temp_answer", "Old.")
+            await bot.get_puzzle.callback(ctx)
+            await answering[0]
+
+        assert answer_ctx.send.await_args.kwargs["embed"].description == "New."
+
+    async def test_unexpected_generation_error_stores_placeholder(self, temp_history_file):
+        """A non-API failure should still store an answer instead of crashing."""
+        generation = asyncio.get_running_loop().create_future()
+        generation.set_exception(KeyError("content"))
+        posted = asyncio.get_running_loop().create_future()
+        posted.set_result(None)
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, '_pending_answer', {"task": None}):
+            task = asyncio.create_task(bot._store_puzzle_answer(generation, posted, MagicMock(), "shown"))
+            bot._pending_answer["task"] = task
+            await task
+            history = bot.load_history()
+
+        assert history["temp_answer"] == "(Answer not available)"
+
+
+class TestSummaryQueue:
+    """Tests for background summarization before history commits."""
+
+    async def test_post_sent_before_summary(self, temp_history_file):
+        """The summary call should happen after delivery, then land in history."""
+        events = []
+        queue = bot.SummaryQueue()
+
+        async def summarize(content):
+            events.append("summary")
+            return "One sentence."
+
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'generate_summary', side_effect=summarize):
+            post = {"mode": "fact", "topic": "optics", "content": "Light bends.", "date": "2026-10-16T19:00:00"}
+            queue.submit([post])
+            events.append("sent")
+            await queue.join()
+            history = bot.load_history()
+
+        assert events == ["sent", "summary"]
+        assert history["posts"][0]["summary"] == "One sentence."
+
+    async def test_failed_summary_falls_back(self, temp_history_file):
+        """A failed summary call should still commit the post."""
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'generate_summary', AsyncMock(side_effect=make_status_error(500))):
+            await bot.SummaryQueue().process([{"mode": "fact", "content": "Light bends. A lot."}])
+            history = bot.load_history()
+
+        assert history["posts"][0]["summary"] == "Light bends"
+
+    async def test_generators_skip_summary(self, fresh_breaker):
+        """Generators should make a single model call and return no summary."""
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("A fact."))) as create:
+            result = await bot.generate_what_if(bot._empty_history())
+
+        assert create.await_count == 1
+        assert "summary" not in result
+
+
+class TestUsageLedger:
+    """Tests for per-request model usage accounting."""
+
+    @pytest.fixture
+    def ledger(self):
+        ledger = bot.UsageLedger(size=10)
+        with patch.object(bot, 'usage_ledger', ledger), \
+                patch.object(bot, 'MODEL_PRICES', {"gen": (3.0, 15.0), "sum": (1.0, 5.0)}):
+            yield ledger
+
+    async def test_calls_charged_to_request(self, ledger, fresh_breaker):
+        """Calls inside a request should add up tokens and estimated cost."""
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("x", 1000, 200))):
+            with ledger.request("!fact") as usage:
+                await bot.call_claude("gen", 10, "p")
+                await bot.call_claude("sum", 10, "p")
+
+        assert len(usage.calls) == 2
+        assert usage.cost == pytest.approx((1000 * 3 + 200 * 15 + 1000 * 1 + 200 * 5) / 1_000_000)
+        assert ledger.totals["!fact"]["requests"] == 1
+        assert ledger.totals["!fact"]["input_tokens"] == 2000
+
+    async def test_on_demand_commands_skip_summary_model(self, temp_history_file, fresh_breaker):
+        """!whatif should cost exactly one generation call and no summary call."""
+        # Commands are metered by the module ledger they were decorated with
+        ledger = bot.usage_ledger
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'content_pool', bot.ContentPool(low=1, high=0)), \
+                patch.object(bot.claude.messages, 'stream', return_value=FakeStream("What if?")):
+            await bot.get_what_if.callback(make_ctx())
+
+        request = ledger.recent[-1]
+        assert request.kind == "!whatif"
+        assert [call["model"] for call in request.calls] == [bot.GENERATION_MODEL]
+
+    def test_unknown_model_costs_nothing(self, ledger):
+        """Models without a price should still be counted, at zero cost."""
+        ledger.record_call("mystery", make_message("", 5, 5).usage, 0.1)
+
+        assert ledger.totals["other"]["calls"] == 1
+        assert ledger.totals["other"]["cost"] == 0.0
+
+
+class TestStructuredGeneration:
+    """Tests for single-call structured generation."""
+
+    @pytest.fixture(autouse=True)
+    def _breaker(self, fresh_breaker):
+        yield
+
+    async def test_fact_with_summary_in_one_call(self):
+        """Content and summary should come from a single forced tool call."""
+        reply = make_tool_message({"content": "Glass is slow.", "summary": "Glass flows? No."})
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=reply)) as create:
+            result = await bot.generate_fact(bot._empty_history(), with_summary=True)
+
+        assert create.await_count == 1
+        assert create.call_args.kwargs["tool_choice"] == {"type": "tool", "name": "submit_post"}
+        assert (result["content"], result["summary"]) == ("Glass is slow.", "Glass flows? No.")
+
+    async def test_prompts_carry_only_their_own_guidelines(self):
+        """Each mode's requirements should be in its own prompt, not shared across modes."""
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=make_message("Fact."))) as create:
+            await bot.generate_fact(bot._empty_history())
+
+        assert "system" not in create.call_args.kwargs
+        prompt = create.call_args.kwargs["messages"][0]["content"]
+        assert "Lead with the surprise" in prompt
+        assert "Close with 🤔" not in prompt and "What If?" not in prompt
+
+    async def test_invalid_output_falls_back_to_plain_call(self):
+        """Missing content should fall back to a plain text generation."""
+        replies = [make_tool_message({"summary": "No body."}), make_message("Plain fact.")]
+        with patch.object(bot.claude.messages, 'create', AsyncMock(side_effect=replies)):
+            result = await bot.generate_what_if(bot._empty_history(), with_summary=True)
+
+        assert result["content"] == "Plain fact."
+        assert "summary" not in result
+
+    async def test_missing_summary_filled_separately(self):
+        """A missing summary should be left for the separate summary call."""
+        reply = make_tool_message({"content": "Glass is slow.", "summary": "  "})
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=reply)), \
+                patch.object(bot, 'generate_summary', AsyncMock(return_value="Separate.")) as summarize:
+            result = await bot.generate_fact(bot._empty_history(), with_summary=True)
+            await bot.summarize_posts([result])
+
+        summarize.assert_awaited_once_with("Glass is slow.")
+        assert result["summary"] == "Separate."
+
+    async def test_puzzle_answer_is_a_field(self):
+        """Pooled puzzles should get their answer without the ANSWER: split."""
+        reply = make_tool_message({"content": "Which falls faster? 🤔", "answer": "Neither. ANSWER: same."})
+        with patch.object(bot.claude.messages, 'create', AsyncMock(return_value=reply)):
+            result = await bot.generate_puzzle(bot._empty_history())
+
+        assert result["content"] == "Which falls faster? 🤔"
+        assert result["answer"] == "Neither. ANSWER: same."
+
+
+class TestSingleFlight:
+    """Tests for coalescing identical in-flight generations."""
+
+    async def test_concurrent_requests_share_one_call(self):
+        """Identical concurrent requests should run start() once and all get the result."""
+        calls = []
+        seen = {"a": [], "b": []}
+
+        async def start(publish):
+            calls.append(1)
+            publish("partial")
+            await asyncio.sleep(0.01)
+            return {"content": "done"}
+
+        flights = bot.SingleFlight()
+        first, second = await asyncio.gather(
+            flights.run("k", start, seen["a"].append),
+            flights.run("k", start, seen["b"].append),
+        )
+
+        assert len(calls) == 1 and flights.coalesced == 1
+        assert first == second == {"content": "done"} and first is not second
+        assert seen == {"a": ["partial"], "b": ["partial"]}
+        assert flights.in_flight() == 0
+
+    async def test_one_waiter_leaving_does_not_cancel_others(self):
+        """Cancelling one waiter should leave the shared generation running."""
+        release = asyncio.Event()
+
+        async def start(publish):
+            await release.wait()
+            return "done"
+
+        flights = bot.SingleFlight()
+        leaver = asyncio.create_task(flights.run("k", start))
+        stayer = asyncio.create_task(flights.run("k", start))
+        await asyncio.sleep(0)
+        leaver.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await stayer == "done"
+        assert leaver.cancelled()
+
+    async def test_last_waiter_leaving_cancels_generation(self):
+        """With nobody waiting, the generation should be cancelled."""
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def start(publish):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        flights = bot.SingleFlight()
+        waiter = asyncio.create_task(flights.run("k", start))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+        assert flights.in_flight() == 0
+
+    async def test_topic_requests_coalesce_across_spelling(self, temp_history_file, fresh_breaker):
+        """Two !fact calls for the same topic should make one model call."""
+        stream = GatedStream("Black holes ", "evaporate.", gate_at=1)
+        ctxs = [make_ctx(), make_ctx()]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'single_flight', bot.SingleFlight()), \
+                patch.object(bot.claude.messages, 'stream', return_value=stream) as open_stream:
+            commands = [
+                asyncio.create_task(bot.get_fact.callback(ctxs[0], topic="black holes")),
+                asyncio.create_task(bot.get_fact.callback(ctxs[1], topic="  Black   Holes")),
+            ]
+            await asyncio.sleep(0.01)
+            stream.release.set()
+            await asyncio.gather(*commands)
+
+        assert open_stream.call_count == 1
+        for ctx in ctxs:
+            assert ctx.message_sent.edit.await_args.kwargs["embed"].description == "Black holes evaporate."
+        requests = list(bot.usage_ledger.recent)[-2:]
+        assert sorted(request.coalesced for request in requests) == [False, True]
+        assert [request.calls for request in requests if request.coalesced] == [[]]
+
+    async def test_random_requests_are_not_coalesced(self, temp_history_file, fresh_breaker):
+        """Concurrent random !whatif requests should each get their own generation."""
+        streams = [GatedStream("What if A?", gate_at=0), GatedStream("What if B?", gate_at=0)]
+        ctxs = [make_ctx(), make_ctx()]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'content_pool', bot.ContentPool(low=1, high=0)), \
+                patch.object(bot.claude.messages, 'stream', side_effect=streams):
+            commands = [asyncio.create_task(bot.get_what_if.callback(ctx)) for ctx in ctxs]
+            await asyncio.sleep(0.01)
+            for stream in streams:
+                stream.release.set()
+            await asyncio.gather(*commands)
+
+        descriptions = {ctx.message_sent.edit.await_args.kwargs["embed"].description for ctx in ctxs}
+        assert descriptions == {"What if A?", "What if B?"}
+
+
+class TestTopicCache:
+    """Tests for the TTL + LRU cache of !fact <topic> replies."""
+
+    def test_normalize_topic(self):
+        """Case, whitespace and simple plurals should not matter."""
+        assert bot.normalize_topic("  Black   Holes ") == bot.normalize_topic("black hole")
+        assert bot.normalize_topic("Galaxies") == "galaxy"
+        assert bot.normalize_topic("physics") == "physics"
+        assert bot.normalize_topic("chaos") == "chaos"
+        assert bot.normalize_topic("Fourier series") == "fourier series"
+        assert bot.normalize_topic("species") != bot.normalize_topic("specy")
+        assert bot.normalize_topic("calories") == "calorie"
+
+    def test_round_robin_once_full(self):
+        """Should miss until every variant exists, then cycle through them."""
+        cache = bot.TopicCache(size=4, variants=2, ttl=60, refresh_ahead=0)
+        assert cache.get("entropy") is None
+        cache.add("entropy", "A")
+        assert cache.get("Entropy") is None
+        cache.add("entropy", "B")
+
+        assert [cache.get("entropy") for _ in range(3)] == ["A", "B", "A"]
+        assert (cache.hits, cache.misses) == (3, 2)
+
+    def test_expired_entries_miss(self):
+        """Entries past their TTL should be dropped."""
+        cache = bot.TopicCache(size=4, variants=1, ttl=-1, refresh_ahead=0)
+        cache.add("primes", "A")
+
+        assert cache.get("primes") is None
+
+    def test_least_recently_used_evicted(self):
+        """Should drop the least recently used topic when full."""
+        cache = bot.TopicCache(size=2, variants=1, ttl=60, refresh_ahead=0)
+        cache.add("entropy", "A")
+        cache.add("primes", "B")
+        cache.get("entropy")
+        cache.add("optics", "C")
+
+        assert cache.get("primes") is None
+        assert cache.get("entropy") == "A"
+
+    async def test_refreshes_near_expiry(self):
+        """A hit close to expiry should regenerate the variants in the background."""
+        cache = bot.TopicCache(size=2, variants=1, ttl=60, refresh_ahead=120)
+        cache.add("entropy", "old")
+        with patch.object(bot, 'generate_topic_fact', AsyncMock(return_value="new")) as generate:
+            assert cache.get("entropy") == "old"
+            await asyncio.sleep(0.01)
+
+        generate.assert_awaited_once_with("entropy")
+        assert cache.refreshes == 1
+        assert cache.get("entropy") == "new"
+
+    async def test_refresh_runs_at_background_priority(self):
+        """A refresh started by a command shouldn't inherit its priority or user."""
+        cache = bot.TopicCache(size=2, variants=1, ttl=60, refresh_ahead=120)
+        cache.add("entropy", "old")
+        callers = []
+
+        async def generate(topic):
+            callers.append(bot.model_scheduler.caller.get())
+            raise KeyError("content")
+
+        with patch.object(bot, 'generate_topic_fact', side_effect=generate):
+            with bot.model_scheduler.request(bot.PRIORITY_ON_DEMAND, "user-1"):
+                cache.get("entropy")
+            await cache._refreshing["entropy"]
+
+        assert callers == [(bot.PRIORITY_BACKGROUND, None)]
+        assert cache._refreshing == {}
+
+    async def test_repeated_topic_served_from_cache(self, temp_history_file, fresh_breaker):
+        """The second !fact for a topic should not call the model."""
+        cache = bot.TopicCache(size=4, variants=1, ttl=60, refresh_ahead=0)
+        ctxs = [make_ctx(), make_ctx()]
+        with patch.object(bot, 'HISTORY_FILE', temp_history_file), \
+                patch.object(bot, 'topic_cache', cache), \
+                patch.object(bot.claude.messages, 'stream', return_value=FakeStream("Entropy wins.")) as open_stream:
+            await bot.get_fact.callback(ctxs[0], topic="Entropy")
+            await bot.get_fact.callback(ctxs[1], topic="entropy")
+
+        assert open_stream.call_count == 1
+        assert ctxs[1].send.await_args.kwargs["embed"].description == "Entropy wins."
+
+
+class TestModelScheduler:
+    """Tests for rate-limited, prioritized, fair admission of model calls."""
+
+    @pytest.fixture
+    def scheduler(self):
+        """A scheduler whose request bucket is empty and refills every 5ms."""
+        scheduler = bot.ModelScheduler(requests_per_minute=60, tokens_per_minute=100_000)
+        scheduler.requests.available = 0
+        scheduler.requests.per_second = 200
+        return scheduler
+
+    async def _admit_in_order(self, scheduler, callers):
+        """Queue one call per (priority, user) in order; return the admission order."""
+        order = []
+
+        async def call(name, priority, user):
+            with scheduler.request(priority, user):
+                await scheduler.acquire(10)
+            order.append(name)
+
+        tasks = []
+        for name, priority, user in callers:
+            tasks.append(asyncio.create_task(call(name, priority, user)))
+            await asyncio.sleep(0)  # Arrive in this order
+        await asyncio.gather(*tasks)
+        return order
+
+    def test_bucket_admits_within_rate(self):
+        """Calls within the buckets should be admitted without queueing."""
+        scheduler = bot.ModelScheduler(requests_per_minute=2, tokens_per_minute=1000)
+
+        assert scheduler._admit(400) and scheduler._admit(400)
+        assert not scheduler._admit(10)  # Out of requests
+
+    async def test_priority_order(self, scheduler):
+        """Digest calls should go first, then on-demand, then background."""
+        order = await self._admit_in_order(scheduler, [
+            ("pool", bot.PRIORITY_BACKGROUND, None),
+            ("command", bot.PRIORITY_ON_DEMAND, 1),
+            ("digest", bot.PRIORITY_DIGEST, None),
+        ])
+
+        assert order == ["digest", "command", "pool"]
+
+    async def test_users_take_turns(self, scheduler):
+        """A user with several queued calls shouldn't hold up another user's first."""
+        order = await self._admit_in_order(scheduler, [
+            ("a1", bot.PRIORITY_ON_DEMAND, "a"),
+            ("a2", bot.PRIORITY_ON_DEMAND, "a"),
+            ("a3", bot.PRIORITY_ON_DEMAND, "a"),
+            ("b1", bot.PRIORITY_ON_DEMAND, "b"),
+        ])
+
+        assert order == ["a1", "b1", "a2", "a3"]
+
+    async def test_queue_position_reported(self, scheduler):
+        """A queued caller should be told its position."""
+        positions = []
+        with scheduler.notifying(positions.append):
+            first = asyncio.create_task(scheduler.acquire(10))
+            await asyncio.sleep(0)
+            second = asyncio.create_task(scheduler.acquire(10))
+            await asyncio.gather(first, second)
+
+        assert positions == [1, 2]
+
+    async def test_queue_notice_keeps_its_send_task(self):
+        """The notice's send task should be held until it finishes."""
+        ctx = make_ctx()
+        notify = bot._queue_notice(ctx)
+        notify(3)
+        notify(4)
+
+        assert len(bot._notice_tasks) == 1
+        await asyncio.gather(*bot._notice_tasks)
+        await asyncio.sleep(0)
+        assert bot._notice_tasks == set()
+        ctx.send.assert_awaited_once_with("Busy right now, you're #3 in line...")
+
+    async def test_cancelled_waiter_is_skipped(self, scheduler):
+        """A cancelled queued call shouldn't use up capacity."""
+        scheduler.requests.per_second = 20  # 50ms per request
+        leaver = asyncio.create_task(scheduler.acquire(10))
+        await asyncio.sleep(0)
+        stayer = asyncio.create_task(scheduler.acquire(10))
+        await asyncio.sleep(0)
+        leaver.cancel()
+        await asyncio.wait_for(stayer, 0.09)
+
+        assert leaver.cancelled()
+
+    async def test_cancel_after_admission_frees_the_slot(self):
+        """A waiter cancelled between admission and resuming should give its slot back."""
+        scheduler = bot.ModelScheduler(requests_per_minute=600, tokens_per_minute=100_000)
+        scheduler.concurrency.limit = 1
+        await scheduler.acquire(10)
+        waiter = asyncio.create_task(scheduler.acquire(10))
+        await asyncio.sleep(0)
+        entry = scheduler._queue[0]
+
+        scheduler.release()
+        while not entry[3].done():
+            await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        assert scheduler.concurrency.in_flight == 0
+        assert scheduler.concurrency.has_room()
+
+
+def rate_limit_headers(remaining: int, limit: int = 100) -> dict:
+    return {
+        "anthropic-ratelimit-requests-limit": str(limit),
+        "anthropic-ratelimit-requests-remaining": str(remaining),
+    }
+
+
+class TestAdaptiveConcurrency:
+    """Tests for the AIMD concurrency limit driven by rate-limit headers."""
+
+    @pytest.fixture
+    def concurrency(self):
+        with patch.object(bot, 'API_CONCURRENCY_DECREASE_INTERVAL', 0):
+            yield bot.AdaptiveConcurrency(minimum=1, maximum=8)
+
+    def test_low_headroom_halves_limit(self, concurrency):
+        """Little remaining quota should halve the limit, down to the minimum."""
+        concurrency.observe(200, rate_limit_headers(remaining=10))
+        assert int(concurrency.limit) == 4
+        for _ in range(5):
+            concurrency.observe(200, rate_limit_headers(remaining=10))
+        assert int(concurrency.limit) == 1
+
+    def test_429_halves_limit(self, concurrency):
+        concurrency.observe(429, {})
+
+        assert int(concurrency.limit) == 4
+
+    def test_headroom_ramps_back_up(self, concurrency):
+        """Plenty of remaining quota should grow the limit additively to the maximum."""
+        concurrency.limit = 2.0
+        for _ in range(3):
+            concurrency.observe(200, rate_limit_headers(remaining=90))
+        assert int(concurrency.limit) == 3
+        for _ in range(100):
+            concurrency.observe(200, rate_limit_headers(remaining=90))
+        assert concurrency.limit == 8
+
+    def test_tightest_limit_wins(self, concurrency):
+        """Headroom should be the smallest remaining fraction across limits."""
+        headers = rate_limit_headers(remaining=90)
+        headers["anthropic-ratelimit-tokens-limit"] = "1000"
+        headers["anthropic-ratelimit-tokens-remaining"] = "50"
+        concurrency.observe(200, headers)
+
+        assert concurrency.headroom == 0.05
+
+    def test_decreases_are_spaced_out(self):
+        """A burst of low-headroom responses should only halve once per interval."""
+        concurrency = bot.AdaptiveConcurrency(minimum=1, maximum=8)
+        for _ in range(5):
+            concurrency.observe(200, rate_limit_headers(remaining=10))
+
+        assert int(concurrency.limit) == 4
+
+    async def test_limit_caps_calls_in_flight(self, fresh_breaker):
+        """No more calls than the current limit should run at once."""
+        in_flight, peak = 0, 0
+
+        async def slow_create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return make_message("ok")
+
+        scheduler = bot.ModelScheduler(100, 100_000, max_concurrency=3)
+        with patch.object(bot, 'model_scheduler', scheduler), \
+                patch.object(bot.claude.messages, 'create', side_effect=slow_create):
+            await asyncio.gather(*(bot.call_claude("m", 10, "p") for _ in range(10)))
+
+        assert peak == 3
+        assert scheduler.concurrency.in_flight == 0
+
+    async def test_client_hook_feeds_scheduler(self, fresh_scheduler):
+        """The Anthropic client's response hook should update the shared limit."""
+        [hook] = bot.claude._client.event_hooks["response"]
+        await hook(httpx.Response(200, headers=rate_limit_headers(remaining=5)))
+
+        assert fresh_scheduler.concurrency.headroom == 0.05
+        assert "headroom 5%" in fresh_scheduler.describe()
+
+
+class TestHedging:
+    """Tests for hedged requests past the rolling p95."""
+
+    @pytest.fixture
+    def hedger(self):
+        """A hedger that hedges !fact calls slower than 10ms."""
+        hedger = bot.Hedger({"!fact": 1.0}, window=10, min_samples=1)
+        hedger.record(("slow-model", False), 0.01)
+        hedger.record(("slow-model", True), 0.01)
+        with patch.object(bot, 'hedger', hedger):
+            yield hedger
+
+    def test_p95_needs_enough_samples(self):
+        hedger = bot.Hedger({}, window=100, min_samples=20)
+        for i in range(19):
+            hedger.record(("m", False), float(i))
+        assert hedger.p95(("m", False)) is None
+
+        for i in range(19, 100):
+            hedger.record(("m", False), float(i))
+        assert hedger.p95(("m", False)) == 95.0
+
+    async def test_slow_call_is_hedged(self, hedger):
+        """The hedge should win against a stalled primary, which gets cancelled."""
+        primary_cancelled = asyncio.Event()
+
+        async def start(model, on_response, on_admit):
+            on_admit()
+            if model == "slow-model":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    primary_cancelled.set()
+                    raise
+            return f"from {model}"
+
+        with bot.usage_ledger.request("!fact"), patch.object(bot, 'HEDGE_MODEL', "fast-model"):
+            result = await hedger.run("slow-model", start, streaming=False)
+
+        assert result == ("from fast-model", "fast-model")
+        await asyncio.wait_for(primary_cancelled.wait(), 1)
+        assert (hedger.hedges["!fact"], hedger.wins["!fact"]) == (1, 1)
+        assert len(hedger._latencies[("slow-model", False)]) == 2  # The loser's time counts too
+
+    async def test_queued_call_is_not_hedged(self, hedger):
+        """Time spent waiting for a scheduler slot shouldn't trigger a hedge."""
+        started = []
+
+        async def start(model, on_response, on_admit):
+            started.append(model)
+            await asyncio.sleep(0.03)  # Queued
+            on_admit()
+            return "done"
+
+        with bot.usage_ledger.request("!fact"):
+            await hedger.run("slow-model", start, streaming=False)
+
+        assert started == ["slow-model"]
+        assert hedger.hedges == {}
+
+    async def test_cancelled_contenders_raise_cancelled(self, hedger):
+        """With no winner and no error, run() should raise CancelledError."""
+        async def start(model, on_response, on_admit):
+            raise asyncio.CancelledError
+
+        with bot.usage_ledger.request("summary"), pytest.raises(asyncio.CancelledError):
+            await hedger.run("slow-model", start, streaming=False)
+
+    async def test_budget_caps_hedges(self, hedger):
+        """Request kinds without budget should never be hedged."""
+        started = []
+
+        async def start(model, on_response, on_admit):
+            on_admit()
+            started.append(model)
+            await asyncio.sleep(0.03)
+            return "done"
+
+        with bot.usage_ledger.request("summary"):
+            await hedger.run("slow-model", start, streaming=False)
+
+        assert started == ["slow-model"]
+        assert hedger.hedges == {}
+
+    async def test_streamed_hedge_forwards_only_winner(self, hedger, fresh_breaker):
+        """Only the first stream to produce text should reach on_text."""
+        seen = []
+        stalled = GatedStream("never shown", gate_at=0)
+        with bot.usage_ledger.request("!fact") as usage, \
+                patch.object(bot.claude.messages, 'stream', side_effect=[stalled, FakeStream("Hedge ", "wins.")]):
+            result = await bot.call_claude("slow-model", 10, "p", on_text=seen.append)
+
+        assert result == "Hedge wins."
+        assert seen == ["Hedge ", "Hedge wins."]
+        assert len(usage.calls) == 2  # The cancelled stream was still billed
+
+
 # =============================================================================
 # EMPTY HISTORY TESTS
 # =============================================================================